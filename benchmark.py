@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import opus2tonie
+
+TIMESTAMP = 0x5E000000
+SERIAL_NO = 0x4F505553
+TRACKS = 3
+DEFAULT_DURATION = 600
+
+# frame size in ms -> config value (fullband CELT), samples per frame
+FRAME_SIZES = {
+    2.5: (28, 120),
+    5: (29, 240),
+    10: (30, 480),
+    20: (31, 960)
+}
+
+SCENARIOS = {
+    "vbr-20ms": {"frame_size": 20, "framepackings": [0], "min_size": 80, "max_size": 480},
+    "cbr-20ms": {"frame_size": 20, "framepackings": [0], "min_size": 240, "max_size": 240},
+    "vbr-mixed-framepacking": {"frame_size": 20, "framepackings": [0, 1, 2, 3], "min_size": 100, "max_size": 700},
+    "vbr-10ms": {"frame_size": 10, "framepackings": [0, 3], "min_size": 40, "max_size": 300},
+    "cbr-2.5ms": {"frame_size": 2.5, "framepackings": [0, 1, 2, 3], "min_size": 30, "max_size": 30},
+    # tiny packets fill the lacing table before the page, the padding has to be spread over several packets
+    "dense-20ms": {"frame_size": 20, "framepackings": [0], "min_size": 10, "max_size": 15}
+}
+
+# sha1 of the generated input tracks, the Tonie file and the concatenated split tracks
+# for DEFAULT_DURATION, any change of these means the produced bytes changed
+GOLDEN_SHA1 = {
+    "vbr-20ms": {
+        "input": "81b8b875ecb1f9cc77ef04159eda43728eec83a1",
+        "tonie": "da2dfacde2c849c8a2717043ef85127f6d6cbda7",
+        "split": "5775cce64531a70d3cfc0f876e29ba3efcfb689e"
+    },
+    "cbr-20ms": {
+        "input": "c654347588f2c424bce9bc800e718cc85a676083",
+        "tonie": "471c761f691a44a7193d578bf7c26200d1927ebe",
+        "split": "70f8e64e4cbd95fd0e740128a5be0fdcb1dfda2f"
+    },
+    "vbr-mixed-framepacking": {
+        "input": "2d3d4289e2ebc3190455669fff260ee30ee424f4",
+        "tonie": "5b97cc1d4e1f96e9ce4d013b8636f87a3d994f46",
+        "split": "368548a0e74f2f0f2d7485f3976c30419c448221"
+    },
+    "vbr-10ms": {
+        "input": "3680bea27392f6485a21bcb7724d86bdbb74a963",
+        "tonie": "8a18cbf688b111201cfedb96f103f5ba7d16732d",
+        "split": "49b553e52456dd74922f64838da1c22c39f97b7d"
+    },
+    "cbr-2.5ms": {
+        "input": "f5d84c38312a26c3387ce257aac4dc3056c9dc8c",
+        "tonie": "4d73680feb5b82da3c1e84ff849ed726d1a0ee19",
+        "split": "e1486e3a1ec58aed8f07b474bd3f514ef57b01b7"
+    },
+    "dense-20ms": {
+        "input": "5afd1bb895addfa4a3b2cbd9872daa6d0f2b8966",
+        "tonie": "8b56f454c0d8aae35e7e36c5e5566eed2906f1d4",
+        "split": "a9bf13ff6a1f999b59e2097a732e11566e276d87"
+    }
+}
+
+STAGES = ["crc", "parse", "decode", "pack", "pack_stream", "info", "info_quick", "split"]
+
+
+def write_ogg_page(out_file, page_type, granule, page_no, packets):
+    lacing_values = bytearray()
+    for packet in packets:
+        lacing_values += b"\xFF" * (len(packet) // 255)
+        lacing_values.append(len(packet) % 255)
+    if len(lacing_values) > 255:
+        raise RuntimeError("Too many segments: {} - max 255 allowed".format(len(lacing_values)))
+    page = bytearray(struct.pack("<4sBBQLLLB", b"OggS", 0, page_type, granule, SERIAL_NO, page_no, 0,
+                                 len(lacing_values)))
+    page += lacing_values
+    for packet in packets:
+        page += packet
+    struct.pack_into("<L", page, 22, opus2tonie.crc32_zlib(page))
+    out_file.write(page)
+
+
+def create_packet(rnd, toc_byte, framepacking, size):
+    # frame sizes follow RFC 6716 3.2, so the packets stay valid even if their payload is not decodable
+    if framepacking == 0:
+        return bytes([toc_byte]) + rnd.getrandbits(8 * (size - 1)).to_bytes(size - 1, "little")
+    if framepacking == 1:
+        # two frames of equal size
+        payload_size = (size - 1) // 2 * 2
+        return bytes([toc_byte]) + rnd.getrandbits(8 * payload_size).to_bytes(payload_size, "little")
+    if framepacking == 2:
+        # the first of the two frames gets a third of the payload
+        first_size = min(251, (size - 2) // 3)
+        return bytes([toc_byte, first_size]) + rnd.getrandbits(8 * (size - 2)).to_bytes(size - 2, "little")
+    # cbr frames, the payload is split evenly between them
+    frame_count = rnd.randint(1, 3)
+    payload_size = (size - 2) // frame_count * frame_count
+    return bytes([toc_byte, frame_count]) + rnd.getrandbits(8 * payload_size).to_bytes(payload_size, "little")
+
+
+def generate_opus_file(filename, duration, frame_size=20, framepackings=(0,), min_size=240, max_size=240, seed=0,
+                       max_page_size=4000):
+    # synthetic stereo 48 kHz stream of CELT packets, the payload is random and not decodable
+    config_value, frame_samples = FRAME_SIZES[frame_size]
+    rnd = random.Random(seed)
+    with open(filename, "wb") as out_file:
+        opus_head = b"OpusHead" + struct.pack("<BBHLhB", 1, 2, 312, 48000, 0, 0)
+        write_ogg_page(out_file, 2, 0, 0, [opus_head])
+        opus_tags = b"OpusTags" + struct.pack("<L", 9) + b"benchmark" + struct.pack("<L", 0)
+        write_ogg_page(out_file, 0, 0, 1, [opus_tags])
+
+        total_samples = int(duration * 48000)
+        granule = 0
+        page_no = 2
+        packets = []
+        page_size = 0
+        segment_count = 0
+        while granule < total_samples:
+            framepacking = rnd.choice(framepackings)
+            toc_byte = (config_value << 3) | 4 | framepacking
+            packet = create_packet(rnd, toc_byte, framepacking, rnd.randint(min_size, max_size))
+            if packets and (page_size + len(packet) > max_page_size or segment_count + len(packet) // 255 >= 255):
+                write_ogg_page(out_file, 0, granule, page_no, packets)
+                page_no = page_no + 1
+                packets = []
+                page_size = 0
+                segment_count = 0
+            packets.append(packet)
+            page_size = page_size + len(packet)
+            segment_count = segment_count + len(packet) // 255 + 1
+            granule = granule + opus2tonie.get_packet_granule(packet)
+        write_ogg_page(out_file, 4, granule, page_no, packets)
+
+
+def hash_files(filenames):
+    sha1 = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, "rb") as in_file:
+            sha1.update(in_file.read())
+    return sha1.hexdigest()
+
+
+def stage_crc(context):
+    for filename in context["input_files"]:
+        with open(filename, "rb") as raw_file:
+            in_file = opus2tonie.MappedFile(raw_file)
+            for page in opus2tonie.iter_remaining_pages(in_file):
+                page.calc_checksum()
+            in_file.close()
+
+
+def stage_parse(context):
+    for filename in context["input_files"]:
+        with open(filename, "rb") as raw_file:
+            in_file = opus2tonie.MappedFile(raw_file)
+            for page in opus2tonie.iter_remaining_pages(in_file):
+                len(page.packet_starts)
+            in_file.close()
+
+
+def stage_decode(context):
+    for filename in context["input_files"]:
+        with open(filename, "rb") as raw_file:
+            in_file = opus2tonie.MappedFile(raw_file)
+            opus2tonie.skip_first_two_pages(in_file)
+            opus2tonie.OpusTrack(in_file)
+            in_file.close()
+
+
+def stage_pack(context):
+    opus2tonie.create_tonie_file(context["tonie_file"], context["input_files"], user_timestamp=str(TIMESTAMP),
+                                 verbose=False)
+
+
+def stage_pack_stream(context):
+    # a python process stands in for the encoder, the pages are packed while they are read from its pipe
+    copy_script = "import shutil, sys; shutil.copyfileobj(open(sys.argv[1], 'rb'), sys.stdout.buffer)"
+    input_handles = [(filename, opus2tonie.run_encoder_pipeline([[sys.executable, "-c", copy_script, filename]],
+                                                                filename, output="stream"))
+                     for filename in context["input_files"]]
+    opus2tonie.create_tonie_file(context["stream_tonie_file"], context["input_files"],
+                                 user_timestamp=str(TIMESTAMP), input_handles=iter(input_handles), verbose=False)
+
+
+def stage_info(context):
+    info = opus2tonie.get_tonie_file_info(context["tonie_file"])
+    if not info["valid"]:
+        raise RuntimeError("{} is not valid".format(context["tonie_file"]))
+
+
+def stage_info_quick(context):
+    opus2tonie.get_tonie_file_info(context["tonie_file"], True)
+
+
+def stage_split(context):
+    # the chapters are extracted in this process, so that their time and memory are measured
+    with open(context["tonie_file"], "rb") as raw_file:
+        in_file = opus2tonie.MappedFile(raw_file)
+        header_start, header_end, ranges = opus2tonie.get_chapter_ranges(in_file)
+        in_file.close()
+    context["split_files"] = []
+    for index, (start, end, base_granule) in enumerate(ranges):
+        out_filename = os.path.join(context["split_dir"], "{:02d}.opus".format(index + 1))
+        opus2tonie.extract_chapter(context["tonie_file"], out_filename, header_start, header_end, start, end,
+                                   base_granule)
+        context["split_files"].append(out_filename)
+
+
+def run_stage(stage, context, repeat):
+    function = globals()["stage_{}".format(stage)]
+    seconds = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(context)
+            elapsed = time.perf_counter() - start
+            if seconds is None or elapsed < seconds:
+                seconds = elapsed
+
+        # a separate run, tracing the allocations slows the stage down
+        tracemalloc.start()
+        function(context)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"seconds": round(seconds, 4), "peak_memory": peak_memory}
+
+
+def run_scenario(name, duration, repeat, tmp_dir):
+    scenario = SCENARIOS[name]
+    context = {
+        "input_files": [os.path.join(tmp_dir, "{}_{}.opus".format(name, i + 1)) for i in range(TRACKS)],
+        "tonie_file": os.path.join(tmp_dir, "{}.tonie".format(name)),
+        "stream_tonie_file": os.path.join(tmp_dir, "{}_stream.tonie".format(name)),
+        "split_dir": tmp_dir
+    }
+
+    start = time.perf_counter()
+    for i, filename in enumerate(context["input_files"]):
+        generate_opus_file(filename, duration / TRACKS, seed=i, **scenario)
+    generate_seconds = time.perf_counter() - start
+
+    result = {
+        "duration": duration,
+        "input_size": sum(os.path.getsize(filename) for filename in context["input_files"]),
+        "generate_seconds": round(generate_seconds, 4),
+        "stages": {}
+    }
+    for stage in STAGES:
+        result["stages"][stage] = run_stage(stage, context, repeat)
+
+    if hash_files([context["stream_tonie_file"]]) != hash_files([context["tonie_file"]]):
+        raise RuntimeError("Streaming produced a different file than packing whole tracks")
+    result["tonie_size"] = os.path.getsize(context["tonie_file"])
+    result["sha1"] = {
+        "input": hash_files(context["input_files"]),
+        "tonie": hash_files([context["tonie_file"]]),
+        "split": hash_files(context["split_files"])
+    }
+    for filename in context["input_files"] + context["split_files"] + [context["tonie_file"],
+                                                                       context["stream_tonie_file"]]:
+        os.remove(filename)
+
+    if duration == DEFAULT_DURATION:
+        result["golden"] = result["sha1"] == GOLDEN_SHA1[name]
+    else:
+        result["golden"] = None
+    return result
+
+
+def print_comparison(results, baseline):
+    for name, result in results["scenarios"].items():
+        if name not in baseline["scenarios"]:
+            continue
+        print("{}:".format(name), file=sys.stderr)
+        for stage, values in result["stages"].items():
+            old_values = baseline["scenarios"][name]["stages"].get(stage)
+            if old_values is None or not values["seconds"]:
+                continue
+            print("  {:12s} {:8.3f}s -> {:8.3f}s ({:5.2f}x)  peak {:7.1f} MB -> {:7.1f} MB"
+                  .format(stage, old_values["seconds"], values["seconds"], old_values["seconds"] / values["seconds"],
+                          old_values["peak_memory"] / 1024 / 1024, values["peak_memory"] / 1024 / 1024),
+                  file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of opus2tonie.py on synthetic Ogg opus files.')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='only run the given scenario (can be repeated, default: all)')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, metavar='SECONDS',
+                        help='total duration of the generated audio per scenario (default: {}, golden sha1 '
+                             'hashes are only checked for the default)'.format(DEFAULT_DURATION))
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='run every stage N times and report the fastest run (default: 3)')
+    parser.add_argument('--crc', dest='crc_backend', choices=list(opus2tonie.CRC_BACKENDS), default='zlib',
+                        help='ogg checksum implementation to benchmark (default: zlib)')
+    parser.add_argument('--output', metavar='FILE', help='write the JSON results to FILE instead of stdout')
+    parser.add_argument('--compare', metavar='FILE', help='print the speedup against the JSON results in FILE')
+    args = parser.parse_args()
+
+    opus2tonie.set_crc_backend(args.crc_backend)
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": opus2tonie.is_numpy_available(),
+        "crc_backend": args.crc_backend,
+        "scenarios": {}
+    }
+    with tempfile.TemporaryDirectory(prefix="opus2tonie-benchmark-") as tmp_dir:
+        for name in args.scenario or list(SCENARIOS):
+            print("Running {}".format(name), file=sys.stderr)
+            results["scenarios"][name] = run_scenario(name, args.duration, args.repeat, tmp_dir)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out_file:
+            out_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as in_file:
+            print_comparison(results, json.load(in_file))
+
+    mismatches = [name for name, result in results["scenarios"].items() if result["golden"] is False]
+    for name in mismatches:
+        print("[NOT OK] {}: output differs from the golden sha1 hashes".format(name), file=sys.stderr)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,31 @@
 #!/usr/bin/python3
 
 import argparse
+import base64
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import glob
 import hashlib
+import importlib
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
 import os
+import shutil
 import math
 import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-import tonie_header_pb2
-
-try:
-    import librecaptcha
-    import requests
-    import base64
-
-    T2S_AVAILABLE = True
-except ImportError:
-    T2S_AVAILABLE = False
+import zlib
+from array import array
 
 T2S_ENDPOINT = 'https://cxl-services.appspot.com/proxy?url=https://texttospeech.googleapis.com/v1beta1/text:synthesize&token='
 T2S_APIKEY = '6LdBnhQUAAAAAMkYSqdAnkafemcA6JtM1N3hlgiL'
@@ -29,13 +34,28 @@ T2S_SPEED = 1.00  # Speed 0.25 .. 4.00
 T2S_PITCH = 0  # -20.00 .. 20.00
 T2S_VOICE = "de-DE-Wavenet-A"  # A/C/F Woman -- B/D/E Man -- differs between languages
 T2S_LANGUAGE = T2S_VOICE[:4]
+T2S_JOBS = 4  # concurrent requests
 
 SAMPLE_RATE_KHZ = 48
 
+OGG_PAGE_SYNC = b"OggS\x00"
+SYNC_WINDOW_SIZE = 0x10000
+COPY_BUFFER_SIZE = 0x100000
+STREAM_CHUNK_SIZE = 0x40000
+HASH_CHUNK_SIZE = 0x100000
+
+OGG_EXTENSIONS = (".opus", ".ogg", ".oga")
+MATROSKA_EXTENSIONS = (".webm", ".mka", ".mkv")
+
+CACHE_FORMAT = "opus2tonie-cache-1"
+ENCODERS = ["auto", "libopus", "opusenc"]
+CACHE_DEFAULT_SIZE_MB = 2048
+
 ONLY_CONVERT_FRAMEPACKING = -1
 OTHER_PACKET_NEEDED = -2
 DO_NOTHING = -3
 TOO_MANY_SEGMENTS = -4
+PADDING_PLAN_MAX_STEPS = 1024
 
 OPUS_TAGS = [
     bytearray(
@@ -45,6 +65,23 @@ OPUS_TAGS = [
 ]
 
 
+@functools.lru_cache(maxsize=None)
+def import_optional(name):
+    # numpy and the text2speech dependencies are only imported once they are needed
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def is_t2s_available():
+    return import_optional("librecaptcha") is not None and import_optional("requests") is not None
+
+
+def is_numpy_available():
+    return import_optional("numpy") is not None
+
+
 class OpusPacket:
     def __init__(self, filehandle, size=-1, last_size=-1, dont_parse_info=False):
         self.config_value = None
@@ -97,22 +134,10 @@ class OpusPacket:
 
 
     def get_frame_size(self):
-        if self.config_value in [16, 20, 24, 28]:
-            return 2.5
-        elif self.config_value in [17, 21, 25, 29]:
-            return 5
-        elif self.config_value in [18, 22, 26, 30]:
-            return 10
-        elif self.config_value in [19, 23, 27, 31]:
-            return 20
-        else:
-            raise RuntimeError(
-                "Found config value {} in opus packet, but CELT-only encodings (16-31) are required by the box.\n" \
-                "Please encode your input files accordingly or fix your encoding pipeline to do so.\n" \
-                "Did you built libopus with custom modes support?".format(self.config_value))
+        return get_frame_size(self.config_value)
 
     def calc_granule(self):
-        return self.frame_size * self.frame_count * SAMPLE_RATE_KHZ
+        return int(self.frame_size * SAMPLE_RATE_KHZ) * self.frame_count
 
 
     def parse_segment_info(self):
@@ -146,16 +171,17 @@ class OpusPacket:
         self.framepacking = 3
 
 
-    def set_pad_count(self, count):
+    def set_pad_count(self, count, count_size=1):
         assert self.framepacking == 3, "Only code 3 packets can contain padding!"
         assert self.padding == 0, "Packet already padded. Not supported yet!"
 
         frame_count_byte = struct.unpack("<B", self.data[1:2])[0]
         frame_count_byte = frame_count_byte | 0b01000000
 
+        # count_size allows longer than necessary encodings (255 0 instead of 254)
         pad_count_data = bytes()
         val = count
-        while val > 254:
+        while val > 254 or len(pad_count_data) + 1 < count_size:
             pad_count_data = pad_count_data + b"\xFF"
             val = val - 254
         pad_count_data = pad_count_data + struct.pack("<B", val)
@@ -163,6 +189,18 @@ class OpusPacket:
         self.data = self.data[0:1] + struct.pack("<B", frame_count_byte) + pad_count_data + self.data[2:]
 
 
+def get_packet_starts(lacing_values):
+    packet_starts = array("H")
+    size = 0
+    last_length = -1
+    for length in lacing_values:
+        if last_length != 255:
+            packet_starts.append(size)
+        size = size + length
+        last_length = length
+    return packet_starts, size
+
+
 class OggPage:
     def __init__(self, filehandle):
         self.version = None
@@ -174,15 +212,39 @@ class OggPage:
         self.segment_count = None
         self.segments = None
 
+        # compact representation of pages parsed from a MappedFile, replaced by
+        # segments as soon as the page gets modified
+        self.lacing_values = None
+        self.packet_starts = None
+        self.body = None
+        self.body_offset = None
+
         if filehandle is None:
             return
+        if isinstance(filehandle, MappedFile):
+            self.parse_mapped(filehandle)
+            return
         self.parse_header(filehandle)
         self.parse_segments(filehandle)
 
 
-    def parse_header(self, filehandle):
-        header = filehandle.read(27)
-        unpacked = struct.unpack("<BBQLLLB", header[4:27])
+    @property
+    def segments(self):
+        if self.body is not None:
+            self.load_segments()
+        return self._segments
+
+
+    @segments.setter
+    def segments(self, segments):
+        self.page_buffer = None
+        self.lacing_values = None
+        self.packet_starts = None
+        self.body = None
+        self._segments = segments
+
+
+    def set_header_values(self, unpacked):
         self.version = unpacked[0]
         self.page_type = unpacked[1]
         self.granule_position = unpacked[2]
@@ -192,6 +254,64 @@ class OggPage:
         self.segment_count = unpacked[6]
 
 
+    def parse_mapped(self, mapped_file):
+        offset = mapped_file.tell()
+        self.set_header_values(struct.unpack_from("<BBQLLLB", mapped_file.buffer, offset + 4))
+
+        body_start = offset + 27 + self.segment_count
+        lacing_values = mapped_file.buffer[offset + 27:body_start]
+        packet_starts, size = get_packet_starts(lacing_values)
+        if body_start + size > mapped_file.size:
+            raise RuntimeError("Ogg page at offset {} is truncated".format(offset))
+
+        self.set_packets(lacing_values, packet_starts, mapped_file.buffer[body_start:body_start + size])
+        self.body_offset = body_start
+        mapped_file.seek(body_start + size)
+
+
+    def parse_stream(self, stream):
+        # forward only, the stream cannot seek to the next capture pattern
+        header = stream.read(27)
+        if not header:
+            return False
+        if len(header) < 27 or not header.startswith(OGG_PAGE_SYNC):
+            raise RuntimeError("Expected an ogg page in the encoder output")
+        self.set_header_values(struct.unpack_from("<BBQLLLB", header, 4))
+
+        lacing_values = stream.read(self.segment_count)
+        packet_starts, size = get_packet_starts(lacing_values)
+        body = stream.read(size)
+        if len(lacing_values) < self.segment_count or len(body) < size:
+            raise RuntimeError("Ogg page in the encoder output is truncated")
+        self.set_packets(lacing_values, packet_starts, body)
+        return True
+
+
+    def set_packets(self, lacing_values, packet_starts, body):
+        self._segments = None
+        self.page_buffer = None
+        self.lacing_values = lacing_values
+        self.packet_starts = packet_starts
+        self.body = body
+        self.segment_count = len(lacing_values)
+
+
+    def ends_with_partial_packet(self):
+        # the last packet continues on the next page
+        if self.body is not None:
+            return len(self.lacing_values) > 0 and self.lacing_values[-1] == 255
+        return len(self.segments) > 0 and self.segments[-1].spanning_packet
+
+
+    def load_segments(self):
+        self.parse_segments(io.BytesIO(bytes(self.lacing_values) + bytes(self.body)))
+
+
+    def parse_header(self, filehandle):
+        header = filehandle.read(27)
+        self.set_header_values(struct.unpack("<BBQLLLB", header[4:27]))
+
+
     def parse_segments(self, filehandle):
         table = filehandle.read(self.segment_count)
         self.segments = []
@@ -208,6 +328,9 @@ class OggPage:
 
 
     def correct_values(self, last_granule):
+        if self.body is not None:
+            self.correct_mapped_values(last_granule)
+            return
         if len(self.segments) > 255:
             raise RuntimeError("Too many segments: {} - max 255 allowed".format(len(self.segments)))
         granule = 0
@@ -217,257 +340,429 @@ class OggPage:
                     granule = granule + segment.granule
         self.granule_position = last_granule + granule
         self.segment_count = len(self.segments)
-        self.checksum = self.calc_checksum()
-
-
-    def calc_checksum(self):
-        data = b"OggS" + struct.pack("<BBQLLLB", self.version, self.page_type, self.granule_position, self.serial_no,
-                                     self.page_no, 0, self.segment_count)
-        for segment in self.segments:
-            data = data + struct.pack("<B", segment.size)
-        for segment in self.segments:
-            data = data + segment.data
-
-        crc = crc32(data)
-        return crc
+        self.update_checksum()
 
 
-    def get_page_size(self):
-        size = 27 + len(self.segments)
-        for segment in self.segments:
-            size = size + len(segment.data)
-        return size
+    def correct_mapped_values(self, last_granule):
+        granule = 0
+        if not (self.page_no == 0) and not (self.page_no == 1):
+            for start in self.packet_starts:
+                granule = granule + get_packet_granule(self.body, start)
+        self.granule_position = last_granule + granule
+        self.update_checksum()
 
 
-    def get_size_of_first_opus_packet(self):
-        if not len(self.segments):
-            return 0
-        segment_size = self.segments[0].size
-        size = segment_size
-        i = 1
-        while (segment_size == 255) and (i < len(self.segments)):
-            segment_size = self.segments[i].size
-            size = size + segment_size
-            i = i + 1
-        return size
+    def update_checksum(self):
+        # keep the serialized page, write_page reuses it as long as the header is unchanged
+        buffer = self.serialize()
+        self.checksum = crc_function(buffer)
+        struct.pack_into("<L", buffer, 22, self.checksum)
+        self.page_buffer = buffer
 
 
-    def get_segment_count_of_first_opus_packet(self):
-        if not len(self.segments):
-            return 0
-        segment_size = self.segments[0].size
-        count = 1
-        while (segment_size == 255) and (count < len(self.segments)):
-            segment_size = self.segments[count].size
-            count = count + 1
-        return count
-
-
-    def insert_empty_segment(self, index_after, spanning_packet=False, first_packet=False):
-        segment = OpusPacket(None)
-        segment.first_packet = first_packet
-        segment.spanning_packet = spanning_packet
-        segment.size = 0
-        segment.data = bytes()
-        self.segments.insert(index_after + 1, segment)
-
-
-    def get_opus_packet_size(self, seg_start):
-        size = len(self.segments[seg_start].data)
-        seg_start = seg_start + 1
-        while (seg_start < len(self.segments)) and not self.segments[seg_start].first_packet:
-            size = size + self.segments[seg_start].size
-            seg_start = seg_start + 1
-        return size
+    def serialize(self, checksum=0):
+        buffer = bytearray(self.get_page_size())
+        struct.pack_into("<4sBBQLLLB", buffer, 0, b"OggS", self.version, self.page_type, self.granule_position,
+                         self.serial_no, self.page_no, checksum, self.segment_count)
+        if self.body is not None:
+            position = 27 + len(self.lacing_values)
+            buffer[27:position] = self.lacing_values
+            buffer[position:] = self.body
+            return buffer
 
+        segments = self.segments
+        position = 27 + len(segments)
+        buffer[27:position] = bytes([segment.size for segment in segments])
+        for segment in segments:
+            end = position + len(segment.data)
+            buffer[position:end] = segment.data
+            position = end
+        return buffer
 
-    def get_segment_count_of_packet_at(self, seg_start):
-        seg_end = seg_start + 1
-        while (seg_end < len(self.segments)) and not self.segments[seg_end].first_packet:
-            seg_end = seg_end + 1
-        return seg_end - seg_start
 
+    def calc_checksum(self):
+        return crc_function(self.serialize())
 
-    def redistribute_packet_data_at(self, seg_start, pad_count):
-        seg_count = self.get_segment_count_of_packet_at(seg_start)
-        full_data = bytes()
-        for i in range(0, seg_count):
-            full_data = full_data + self.segments[seg_start + i].data
-        full_data = full_data + bytes(pad_count)
-        size = len(full_data)
 
-        if size < 255:
-            self.segments[seg_start].size = size
-            self.segments[seg_start].data = full_data
-            return
+    def get_page_size(self):
+        if self.body is not None:
+            return 27 + len(self.lacing_values) + len(self.body)
+        size = 27 + len(self.segments)
+        for segment in self.segments:
+            size = size + len(segment.data)
+        return size
 
-        needed_seg_count = math.ceil(size / 255)
-        if (size % 255) == 0:
-            needed_seg_count = needed_seg_count + 1
-        segments_to_create = needed_seg_count - seg_count
-        for i in range(0, segments_to_create):
-            self.insert_empty_segment(seg_start + seg_count + i, i != (segments_to_create - 1))
-        seg_count = needed_seg_count
 
-        for i in range(0, seg_count):
-            self.segments[seg_start + i].data = full_data[:255]
-            self.segments[seg_start + i].size = len(self.segments[seg_start + i].data)
-            full_data = full_data[255:]
-        assert len(full_data) == 0
+    def write_page(self, filehandle, sha1=None):
+        buffer = self.page_buffer
+        header = struct.pack("<4sBBQLLLB", b"OggS", self.version, self.page_type, self.granule_position,
+                             self.serial_no, self.page_no, self.checksum, self.segment_count)
+        if buffer is None or buffer[:27] != header:
+            buffer = self.serialize(self.checksum)
+        if sha1 is not None:
+            with measure_stage("sha1"):
+                sha1.update(buffer)
+        with measure_stage("write"):
+            filehandle.write(buffer)
 
 
-    def convert_packet_to_framepacking_three_and_pad(self, seg_start, pad=False, count=0):
-        assert self.segments[seg_start].first_packet is True
-        self.segments[seg_start].convert_to_framepacking_three()
-        if pad:
-            self.segments[seg_start].set_pad_count(count)
-        self.redistribute_packet_data_at(seg_start, count)
+    @staticmethod
+    def from_page(other_page):
+        new_page = OggPage(None)
+        new_page.version = other_page.version
+        new_page.page_type = other_page.page_type
+        new_page.granule_position = other_page.granule_position
+        new_page.serial_no = other_page.serial_no
+        new_page.page_no = other_page.page_no
+        new_page.checksum = 0
+        new_page.segment_count = 0
+        new_page.segments = []
+        return new_page
 
 
-    def calc_actual_padding_value(self, seg_start, bytes_needed):
-        assert bytes_needed >= 0, "Page is already too large! Something went wrong."
+    @staticmethod
+    def seek_to_page_header(filehandle):
+        if isinstance(filehandle, MappedFile):
+            position = filehandle.find(OGG_PAGE_SYNC, filehandle.tell())
+            if position == -1 or position + 27 > filehandle.size:
+                return False
+            filehandle.seek(position)
+            return True
+
+        start = filehandle.tell()
+        data = filehandle.read(len(OGG_PAGE_SYNC))
+        if data == OGG_PAGE_SYNC:
+            filehandle.seek(start)
+            return True
+        while len(data) >= len(OGG_PAGE_SYNC):
+            index = data.find(OGG_PAGE_SYNC)
+            if index != -1:
+                filehandle.seek(start + index)
+                return True
+            keep = len(OGG_PAGE_SYNC) - 1
+            start = start + len(data) - keep
+            data = data[-keep:] + filehandle.read(SYNC_WINDOW_SIZE)
+        return False
 
-        seg_end = seg_start + self.get_segment_count_of_packet_at(seg_start)
-        size_of_last_segment = self.segments[seg_end - 1].size
-        convert_framepacking_needed = self.segments[seg_start].framepacking != 3
 
-        if bytes_needed == 0:
-            return DO_NOTHING
+def calc_padding_value(bytes_needed, size_of_last_segment, convert_framepacking_needed, segment_count):
+    assert bytes_needed >= 0, "Page is already too large! Something went wrong."
 
-        if (bytes_needed + size_of_last_segment) % 255 == 0:
-            return OTHER_PACKET_NEEDED
+    if bytes_needed == 0:
+        return DO_NOTHING
 
-        if bytes_needed == 1:
-            if convert_framepacking_needed:
-                return ONLY_CONVERT_FRAMEPACKING
-            else:
-                return 0
+    if (bytes_needed + size_of_last_segment) % 255 == 0:
+        return OTHER_PACKET_NEEDED
 
-        new_segments_needed = 0
-        if bytes_needed + size_of_last_segment >= 255:
-            tmp_count = bytes_needed + size_of_last_segment - 255
-            while tmp_count >= 0:
-                tmp_count = tmp_count - 255 - 1
-                new_segments_needed = new_segments_needed + 1
+    if bytes_needed == 1:
+        if convert_framepacking_needed:
+            return ONLY_CONVERT_FRAMEPACKING
+        else:
+            return 0
 
-        if new_segments_needed + len(self.segments) > 255:
-            # print("Too many segments needed {}".format(new_segments_needed + len(self.segments)))
-            return TOO_MANY_SEGMENTS
+    new_segments_needed = 0
+    if bytes_needed + size_of_last_segment >= 255:
+        tmp_count = bytes_needed + size_of_last_segment - 255
+        while tmp_count >= 0:
+            tmp_count = tmp_count - 255 - 1
+            new_segments_needed = new_segments_needed + 1
 
-        if (bytes_needed + size_of_last_segment) % 255 == (new_segments_needed - 1):
-            return OTHER_PACKET_NEEDED
+    if new_segments_needed + segment_count > 255:
+        return TOO_MANY_SEGMENTS
 
-        packet_bytes_needed = bytes_needed - new_segments_needed
+    if (bytes_needed + size_of_last_segment) % 255 == (new_segments_needed - 1):
+        return OTHER_PACKET_NEEDED
 
-        if packet_bytes_needed == 1:
-            if convert_framepacking_needed:
-                return ONLY_CONVERT_FRAMEPACKING
-            else:
-                return 0
+    packet_bytes_needed = bytes_needed - new_segments_needed
 
+    if packet_bytes_needed == 1:
         if convert_framepacking_needed:
-            packet_bytes_needed = packet_bytes_needed - 1  # frame_count_byte
-        packet_bytes_needed = packet_bytes_needed - 1  # padding_count_data is at least 1 byte
-        size_of_padding_count_data = max(1, math.ceil(packet_bytes_needed / 254))
-        check_size = math.ceil((packet_bytes_needed - size_of_padding_count_data + 1) / 254)
-
-        if check_size != size_of_padding_count_data:
-            return OTHER_PACKET_NEEDED
+            return ONLY_CONVERT_FRAMEPACKING
         else:
-            return packet_bytes_needed - size_of_padding_count_data + 1
+            return 0
 
+    if convert_framepacking_needed:
+        packet_bytes_needed = packet_bytes_needed - 1  # frame_count_byte
+    packet_bytes_needed = packet_bytes_needed - 1  # padding_count_data is at least 1 byte
+    size_of_padding_count_data = max(1, math.ceil(packet_bytes_needed / 254))
+    check_size = math.ceil((packet_bytes_needed - size_of_padding_count_data + 1) / 254)
 
-    def pad(self, pad_to, idx_offset=-1):
-        # print("page size before {}".format(self.get_page_size()))
-        if idx_offset == -1:
-            idx = len(self.segments) - 1
-        else:
-            idx = idx_offset
+    if check_size != size_of_padding_count_data:
+        return OTHER_PACKET_NEEDED
+    else:
+        return packet_bytes_needed - size_of_padding_count_data + 1
 
-        while not self.segments[idx].first_packet:
-            idx = idx - 1
-            if idx < 0:
-                raise RuntimeError("Could not find begin of last packet!")
 
-        pad_count = pad_to - self.get_page_size()
-        actual_padding = self.calc_actual_padding_value(idx, pad_count)
+def get_pad_count_size(count):
+    size = 1
+    while count > 254:
+        count = count - 254
+        size = size + 1
+    return size
 
-        if actual_padding == DO_NOTHING:
-            return
-        if actual_padding == ONLY_CONVERT_FRAMEPACKING:
-            self.convert_packet_to_framepacking_three_and_pad(idx)
-            return
-        if actual_padding == OTHER_PACKET_NEEDED:
-            self.pad_one_byte()
-            self.pad(pad_to)
-            return
-        if actual_padding == TOO_MANY_SEGMENTS:
-            self.pad(pad_to - (pad_count // 2), idx - 1)
-            self.pad(pad_to)
-            return
 
-        self.convert_packet_to_framepacking_three_and_pad(idx, True, actual_padding)
-        assert self.get_page_size() == pad_to
+class PaddingPlan:
+    def __init__(self, sizes, framepackings, paddings, segment_count, page_size):
+        self.sizes = list(sizes)
+        self.framepackings = list(framepackings)
+        self.paddings = paddings
+        self.segment_count = segment_count
+        self.page_size = page_size
+        self.convert = [False] * len(sizes)
+        self.pad_counts = [None] * len(sizes)
+        self.pad_count_sizes = [1] * len(sizes)
+        self.one_byte_count = 0
+        self.searched = False
 
 
-    def pad_one_byte(self):
-        i = 0
-        while not (self.segments[i].first_packet and not self.segments[i].padding
-                   and self.get_opus_packet_size(i) % 255 < 254):
-            i = i + 1
-            if i >= len(self.segments):
-                raise RuntimeError("Page seems impossible to pad correctly")
+    def grow_packet(self, index, added_bytes):
+        size = self.sizes[index]
+        new_segments = (size + added_bytes) // 255 - size // 255
+        self.sizes[index] = size + added_bytes
+        self.segment_count = self.segment_count + new_segments
+        self.page_size = self.page_size + added_bytes + new_segments
 
-        if self.segments[i].framepacking == 3:
-            self.convert_packet_to_framepacking_three_and_pad(i, True, 0)
-        else:
-            self.convert_packet_to_framepacking_three_and_pad(i)
 
+    def can_pad(self, index):
+        return not self.paddings[index] and self.pad_counts[index] is None
 
-    def write_page(self, filehandle, sha1=None):
-        data = b"OggS" + struct.pack("<BBQLLLB", self.version, self.page_type, self.granule_position, self.serial_no,
-                                     self.page_no, self.checksum, self.segment_count)
-        for segment in self.segments:
-            data = data + struct.pack("<B", segment.size)
-        if sha1 is not None:
-            sha1.update(data)
-        filehandle.write(data)
-        for segment in self.segments:
-            if sha1 is not None:
-                sha1.update(segment.data)
-            segment.write(filehandle)
 
+    def convert_framepacking(self, index):
+        if self.framepackings[index] != 3:
+            self.framepackings[index] = 3
+            self.convert[index] = True
+            self.grow_packet(index, 1)
 
-    @staticmethod
-    def from_page(other_page):
-        new_page = OggPage(None)
-        new_page.version = other_page.version
-        new_page.page_type = other_page.page_type
-        new_page.granule_position = other_page.granule_position
-        new_page.serial_no = other_page.serial_no
-        new_page.page_no = other_page.page_no
-        new_page.checksum = 0
-        new_page.segment_count = 0
-        new_page.segments = []
-        return new_page
 
+    def set_pad_count(self, index, count, count_size=1):
+        if not self.can_pad(index):
+            raise RuntimeError("Packet already padded")
+        self.convert_framepacking(index)
+        self.pad_counts[index] = count
+        self.pad_count_sizes[index] = count_size
+        self.grow_packet(index, max(get_pad_count_size(count), count_size) + count)
 
-    @staticmethod
-    def seek_to_page_header(filehandle):
-        current_pos = filehandle.tell()
-        filehandle.seek(0, 2)
-        size = filehandle.tell()
-        filehandle.seek(current_pos, 0)
-        five_bytes = filehandle.read(5)
-        while five_bytes and (filehandle.tell() + 5 < size):
-            if five_bytes == b"OggS\x00":
-                filehandle.seek(-5, 1)
-                return True
-            filehandle.seek(-4, 1)
-            five_bytes = filehandle.read(5)
-        return False
 
+    def add_one_byte(self, index):
+        self.one_byte_count = self.one_byte_count + 1
+        if self.framepackings[index] == 3:
+            self.set_pad_count(index, 0)
+        else:
+            self.convert_framepacking(index)
+
+
+    def get_one_byte_candidates(self, exclude=-1):
+        # growing these packets by one byte does not change the lacing values
+        return [i for i in range(len(self.sizes)) if i != exclude and self.can_pad(i) and self.sizes[i] % 255 < 254]
+
+
+    def get_previous_paddable(self, index):
+        index = index - 1
+        while index >= 0 and not self.can_pad(index):
+            index = index - 1
+        if index < 0:
+            raise RuntimeError("Page seems impossible to pad correctly")
+        return index
+
+
+    def follow_rules(self, pad_to):
+        # pad the last packet, add single bytes to the first suitable packet until the remaining amount can be
+        # expressed as padding and split the padding with the nearest unpadded packet before it when the lacing
+        # table is full
+        pending = [(pad_to, len(self.sizes) - 1)]
+        steps = 0
+        while len(pending):
+            steps = steps + 1
+            if steps > PADDING_PLAN_MAX_STEPS:
+                raise RuntimeError("Padding rules do not converge")
+            target, index = pending.pop()
+            bytes_needed = target - self.page_size
+            if bytes_needed < 0:
+                raise RuntimeError("Page is already too large")
+
+            value = calc_padding_value(bytes_needed, self.sizes[index] % 255, self.framepackings[index] != 3,
+                                       self.segment_count)
+            if value == DO_NOTHING:
+                continue
+            if value == ONLY_CONVERT_FRAMEPACKING:
+                self.convert_framepacking(index)
+            elif value == OTHER_PACKET_NEEDED:
+                candidates = self.get_one_byte_candidates(index)
+                if not len(candidates):
+                    raise RuntimeError("Page seems impossible to pad correctly")
+                self.add_one_byte(candidates[0])
+                pending.append((target, index))
+            elif value == TOO_MANY_SEGMENTS:
+                pending.append((target, index))
+                pending.append((target - bytes_needed // 2, self.get_previous_paddable(index)))
+            else:
+                self.set_pad_count(index, value)
+                if self.page_size != target:
+                    raise RuntimeError("Padding rules missed the target size")
+        if self.page_size != pad_to:
+            raise RuntimeError("Padding rules missed the target size")
+
+
+    def search(self, pad_to):
+        # one padded packet (preferably the last one) plus single byte adjustments of other packets. If no packet
+        # can take the padding without overflowing the lacing table, the packets are padded one after the other
+        # up to their last lacing value until the rest fits
+        while not self.search_single(pad_to - self.page_size):
+            self.pad_within_segment(pad_to - self.page_size)
+
+
+    def search_single(self, bytes_needed):
+        # padding lengths may use a longer encoding than necessary to hit sizes skipped by the lacing
+        for index in reversed(range(len(self.sizes))):
+            if not self.can_pad(index):
+                continue
+            candidates = self.get_one_byte_candidates(index)
+            size = self.sizes[index]
+            extra = 1 if self.framepackings[index] != 3 else 0
+            best = None
+            for count in range(bytes_needed + 1):
+                min_count_size = get_pad_count_size(count)
+                if extra + min_count_size + count > bytes_needed:
+                    break
+                for count_size in range(min_count_size, count // 254 + 2):
+                    new_size = size + extra + count_size + count
+                    new_segments = new_size // 255 - size // 255
+                    added = new_size - size + new_segments
+                    if added > bytes_needed or self.segment_count + new_segments > 255:
+                        break
+                    if best is None or added > best[2]:
+                        best = (count, count_size, added)
+                if best is not None and best[2] == bytes_needed:
+                    break
+            if best is not None and bytes_needed - best[2] <= len(candidates):
+                for candidate in candidates[:bytes_needed - best[2]]:
+                    self.add_one_byte(candidate)
+                self.set_pad_count(index, best[0], best[1])
+                return True
 
+        candidates = self.get_one_byte_candidates()
+        if bytes_needed > len(candidates):
+            return False
+        for candidate in candidates[:bytes_needed]:
+            self.add_one_byte(candidate)
+        return True
+
+
+    def pad_within_segment(self, bytes_needed):
+        for index in reversed(range(len(self.sizes))):
+            if not self.can_pad(index):
+                continue
+            extra = 1 if self.framepackings[index] != 3 else 0
+            count = min(254 - self.sizes[index] % 255, bytes_needed) - extra - 1
+            if count >= 0:
+                self.set_pad_count(index, count)
+                return
+        raise RuntimeError("Page seems impossible to pad correctly")
+
+
+def plan_padding(sizes, framepackings, paddings, segment_count, page_size, pad_to):
+    plan = PaddingPlan(sizes, framepackings, paddings, segment_count, page_size)
+    try:
+        plan.follow_rules(pad_to)
+    except RuntimeError:
+        plan = PaddingPlan(sizes, framepackings, paddings, segment_count, page_size)
+        plan.searched = True
+        plan.search(pad_to)
+    assert plan.page_size == pad_to
+    return plan
+
+
+class MappedFile:
+    def __init__(self, filehandle):
+        position = filehandle.tell()
+        data = None
+        if isinstance(filehandle, (io.BufferedReader, io.BufferedRandom)):
+            try:
+                data = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass  # e.g. empty files cannot be mapped
+        if data is None:
+            filehandle.seek(0)
+            data = filehandle.read()
+        self.data = data
+        self.buffer = memoryview(data)
+        self.size = len(data)
+        self.position = position
+
+
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self.position + size, self.size)
+        data = bytes(self.buffer[self.position:end])
+        self.position = max(self.position, end)
+        return data
+
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset = self.position + offset
+        elif whence == 2:
+            offset = self.size + offset
+        self.position = max(0, offset)
+        return self.position
+
+
+    def tell(self):
+        return self.position
+
+
+    def find(self, sub, start=0):
+        if self.buffer[start:start + len(sub)] == sub:
+            return start
+        return self.data.find(sub, start)
+
+
+    def close(self):
+        # pages may still reference the buffer, the mapping is released with the last of them
+        self.buffer = None
+        self.data = None
+
+
+def get_frame_size(config_value):
+    if config_value in [16, 20, 24, 28]:
+        return 2.5
+    elif config_value in [17, 21, 25, 29]:
+        return 5
+    elif config_value in [18, 22, 26, 30]:
+        return 10
+    elif config_value in [19, 23, 27, 31]:
+        return 20
+    else:
+        raise RuntimeError(
+            "Found config value {} in opus packet, but CELT-only encodings (16-31) are required by the box.\n" \
+            "Please encode your input files accordingly or fix your encoding pipeline to do so.\n" \
+            "Did you built libopus with custom modes support?".format(config_value))
+
+
+def get_packet_granule(data, offset=0):
+    toc_frame_samples, toc_frame_counts = create_toc_tables()
+    toc_byte = data[offset]
+    frame_samples = toc_frame_samples[toc_byte]
+    if not frame_samples:
+        get_frame_size(toc_byte >> 3)
+    frame_count = toc_frame_counts[toc_byte]
+    if not frame_count:
+        frame_count = data[offset + 1] & 63
+    return frame_samples * frame_count
+
+
+@functools.lru_cache(maxsize=None)
+def create_toc_tables():
+    # samples per frame (0 for non CELT configs) and frame count (0: stored in the next byte) of every toc byte
+    frame_samples = array("H")
+    frame_counts = array("B")
+    for toc_byte in range(256):
+        config_value = toc_byte >> 3
+        frame_samples.append(120 << (config_value & 3) if config_value >= 16 else 0)
+        frame_counts.append([1, 2, 2, 0][toc_byte & 3])
+    return frame_samples, frame_counts
+
+
+@functools.lru_cache(maxsize=None)
 def create_table():
     a = []
     for i in range(256):
@@ -479,6 +774,7 @@ def create_table():
 
 
 def crc32(bytestream):
+    crc_table = create_table()
     crc = 0
     for byte in bytestream:
         lookup_index = ((crc >> 24) ^ byte) & 0xff
@@ -486,17 +782,54 @@ def crc32(bytestream):
     return crc
 
 
+@functools.lru_cache(maxsize=None)
+def create_bit_reverse_table():
+    return bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+
+
+def crc32_zlib(bytestream):
+    # the ogg crc is the unreflected variant of the zlib polynomial with init 0 and no final xor:
+    # feed zlib bit reversed bytes, undo its pre/post inversion and reverse the resulting register
+    bit_reverse_table = create_bit_reverse_table()
+    if isinstance(bytestream, memoryview):
+        bytestream = bytestream.tobytes()
+    crc = zlib.crc32(bytestream.translate(bit_reverse_table), 0xffffffff) ^ 0xffffffff
+    return int.from_bytes(crc.to_bytes(4, "little").translate(bit_reverse_table), "big")
+
+
+def set_crc_backend(name):
+    global crc_function
+    if name not in CRC_BACKENDS:
+        raise RuntimeError("Unknown crc backend {} - available: {}".format(name, ", ".join(CRC_BACKENDS)))
+    crc_function = CRC_BACKENDS[name]
+
+
+CRC_BACKENDS = {
+    "zlib": crc32_zlib,
+    "python": crc32
+}
+crc_function = crc32_zlib
+encoder_backend = "auto"
+t2s_client = None
+t2s_client_lock = threading.Lock()
+
+
 def check_identification_header(page):
     segment = page.segments[0]
     unpacked = struct.unpack("<8sBBHLH", segment.data[0:18])
     assert unpacked[0] == b"OpusHead", "Invalid opus file?"
     assert unpacked[1] == 1, "Invalid opus file?"
     assert unpacked[2] == 2, "Only stereo tracks are supported"
-    assert unpacked[4] == SAMPLE_RATE_KHZ * 1000, "Sample rate needs to be 48 kHz"
+
+
+def set_input_sample_rate(page):
+    # opus is always decoded at 48 kHz, the input sample rate of the header is informational only
+    segment = page.segments[0]
+    segment.data = segment.data[:12] + struct.pack("<L", SAMPLE_RATE_KHZ * 1000) + segment.data[16:]
 
 
 def prepare_opus_tags(page):
-    page.segments.clear()
+    page.segments = []
     segment = OpusPacket(None)
     segment.size = len(OPUS_TAGS[0])
     segment.data = bytearray(OPUS_TAGS[0])
@@ -514,20 +847,36 @@ def prepare_opus_tags(page):
     return page
 
 
-def copy_first_and_second_page(in_file, out_file, timestamp, sha):
+def read_first_and_second_page(in_file):
     found = OggPage.seek_to_page_header(in_file)
     if not found:
         raise RuntimeError("First ogg page not found")
-    page = OggPage(in_file)
+    first_page = OggPage(in_file)
+
+    found = OggPage.seek_to_page_header(in_file)
+    if not found:
+        raise RuntimeError("Second ogg page not found")
+    second_page = OggPage(in_file)
+
+    page = second_page
+    while page.ends_with_partial_packet():
+        # long tags (e.g. with cover art) continue on the next pages, they are replaced anyway
+        found = OggPage.seek_to_page_header(in_file)
+        if not found:
+            raise RuntimeError("Opus tags are truncated")
+        page = OggPage(in_file)
+    return first_page, second_page
+
+
+def write_first_and_second_page(first_page, second_page, out_file, timestamp, sha):
+    page = first_page
     page.serial_no = timestamp
+    set_input_sample_rate(page)
     page.checksum = page.calc_checksum()
     check_identification_header(page)
     page.write_page(out_file, sha)
 
-    found = OggPage.seek_to_page_header(in_file)
-    if not found:
-        raise RuntimeError("Second ogg page not found")
-    page = OggPage(in_file)
+    page = second_page
     page.serial_no = timestamp
     page.checksum = page.calc_checksum()
     page = prepare_opus_tags(page)
@@ -535,69 +884,327 @@ def copy_first_and_second_page(in_file, out_file, timestamp, sha):
 
 
 def skip_first_two_pages(in_file):
-    found = OggPage.seek_to_page_header(in_file)
-    if not found:
-        raise RuntimeError("First ogg page not found")
-    page = OggPage(in_file)
-    check_identification_header(page)
-
-    found = OggPage.seek_to_page_header(in_file)
-    if not found:
-        raise RuntimeError("Second ogg page not found")
-    OggPage(in_file)
+    first_page, second_page = read_first_and_second_page(in_file)
+    check_identification_header(first_page)
 
 
-def read_all_remaining_pages(in_file):
-    remaining_pages = []
-
+def iter_remaining_pages(in_file):
     found = OggPage.seek_to_page_header(in_file)
     while found:
-        remaining_pages.append(OggPage(in_file))
+        yield OggPage(in_file)
         found = OggPage.seek_to_page_header(in_file)
-    return remaining_pages
 
 
-def resize_pages(old_pages, max_page_size, first_page_size, template_page, last_granule=0, start_no=2,
-                 set_last_page_flag=False):
-    new_pages = []
-    page = None
-    page_no = start_no
-    max_size = first_page_size
+def iter_stream_pages(stream):
+    while True:
+        page = OggPage(None)
+        with measure_stage("transcode"):
+            if not page.parse_stream(stream):
+                return
+        yield page
 
-    new_page = OggPage.from_page(template_page)
-    new_page.page_no = page_no
 
-    while len(old_pages) or not (page is None):
+def read_stream_header_pages(pages):
+    first_page = next(pages, None)
+    second_page = next(pages, None)
+    if first_page is None:
+        raise RuntimeError("First ogg page not found")
+    if second_page is None:
+        raise RuntimeError("Second ogg page not found")
+
+    page = second_page
+    while page.ends_with_partial_packet():
+        page = next(pages, None)
         if page is None:
-            page = old_pages.pop(0)
+            raise RuntimeError("Opus tags are truncated")
+    return first_page, second_page
+
+
+def iter_stream_packets(pages, chunk_size=STREAM_CHUNK_SIZE):
+    # hands the packets over in chunks, so decoding them keeps the cost per packet of a whole track
+    packets = []
+    size = 0
+    partial = False
+    for page in pages:
+        check_packet_continuation(page, partial)
+        body = memoryview(page.body)
+        starts = page.packet_starts
+        fragments = [body[start:end] for start, end in zip(starts, starts[1:])]
+        if len(starts):
+            fragments.append(body[starts[-1]:])
+        if page.page_type & 1:
+            packets[-1] = bytes(packets[-1]) + fragments.pop(0)
+        packets.extend(fragments)
+        partial = page.ends_with_partial_packet()
+        size = size + len(body)
+        # a packet that continues on the next page stays in the chunk until it is complete
+        if size >= chunk_size and not partial:
+            yield packets
+            packets = []
+            size = 0
+    if partial:
+        raise RuntimeError("Last opus packet is truncated")
+    if packets:
+        yield packets
+
+
+def check_packet_continuation(page, partial):
+    if bool(page.page_type & 1) != partial:
+        raise RuntimeError("Ogg page {} does not match the packet continuation of the page before".format(page.page_no))
+    if partial and not len(page.packet_starts):
+        raise RuntimeError("Ogg page {} continues a packet without data".format(page.page_no))
+
+
+class OpusTrack:
+    def __init__(self, in_file):
+        self.buffer = b""
+        self.first_page = None
+        self.offsets = array("q")
+        self.sizes = array("L")
+        if in_file is None:
+            return
+
+        self.buffer = in_file.buffer
+        continued = []
+        partial = False
+        for page in iter_remaining_pages(in_file):
+            if self.first_page is None:
+                self.first_page = page
+            check_packet_continuation(page, partial)
+            if partial:
+                continued.append(len(self.sizes))
+            partial = page.ends_with_partial_packet()
+            body_offset = page.body_offset
+            starts = page.packet_starts
+            self.offsets.extend(body_offset + start for start in starts)
+            self.sizes.extend(end - start for start, end in zip(starts, starts[1:]))
+            if len(starts):
+                self.sizes.append(len(page.body) - starts[-1])
+        if partial:
+            raise RuntimeError("Last opus packet is truncated")
+
+        if continued:
+            self.join_fragments(continued)
+        else:
+            self.decode()
+
+
+    def join_fragments(self, continued):
+        # packets spanning pages are copied together, so the track is not backed by the input file anymore
+        continued = set(continued)
+        packets = []
+        for index, (offset, size) in enumerate(zip(self.offsets, self.sizes)):
+            fragment = self.buffer[offset:offset + size]
+            if index in continued:
+                packets[-1] = bytes(packets[-1]) + fragment
+            else:
+                packets.append(fragment)
+        self.set_packets(packets)
+
+
+    def set_packets(self, packets):
+        self.buffer = b"".join(packets)
+        self.sizes = array("L", (len(packet) for packet in packets))
+        self.offsets = array("q", itertools.accumulate(self.sizes, initial=0))
+        self.offsets.pop()
+        self.decode()
+
+
+    def get_packets(self, start):
+        return [self.buffer[offset:offset + size] for offset, size in zip(self.offsets[start:], self.sizes[start:])]
 
-        size = page.get_size_of_first_opus_packet()
-        seg_count = page.get_segment_count_of_first_opus_packet()
 
-        if (size + seg_count + new_page.get_page_size() <= max_size) and (len(new_page.segments) + seg_count < 256):
-            for i in range(seg_count):
-                new_page.segments.append(page.segments.pop(0))
-            if not len(page.segments):
-                page = None
+    def decode(self):
+        numpy = import_optional("numpy")
+        if numpy is not None:
+            self.decode_packets_numpy(numpy)
         else:
-            new_page.pad(max_size)
-            new_page.correct_values(last_granule)
-            last_granule = new_page.granule_position
-            new_pages.append(new_page)
+            self.decode_packets()
+
+
+    def decode_packets(self):
+        toc_frame_samples, toc_frame_counts = create_toc_tables()
+        buffer = self.buffer
+        last_offset = len(buffer) - 1
+        self.check_configs(buffer[offset] for offset in self.offsets)
+
+        self.segment_counts = array("L", (size // 255 + 1 for size in self.sizes))
+        self.framepackings = array("B", (buffer[offset] & 3 for offset in self.offsets))
+        self.paddings = array("B", (framepacking == 3 and (buffer[min(offset + 1, last_offset)] & 64) != 0
+                                    for framepacking, offset in zip(self.framepackings, self.offsets)))
+        granules = (toc_frame_samples[buffer[offset]] *
+                    (toc_frame_counts[buffer[offset]] or (buffer[min(offset + 1, last_offset)] & 63))
+                    for offset in self.offsets)
+        self.cumulative_granules = array("q", itertools.accumulate(granules))
+
+
+    def decode_packets_numpy(self, numpy, window=0x10000):
+        toc_frame_samples, toc_frame_counts = create_toc_tables()
+        toc_frame_samples = numpy.asarray(toc_frame_samples, dtype=numpy.int64)
+        toc_frame_counts = numpy.asarray(toc_frame_counts, dtype=numpy.int64)
+        data = numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+        self.segment_counts = array("L")
+        self.framepackings = array("B")
+        self.paddings = array("B")
+        self.cumulative_granules = array("q")
+        last_granule = 0
+        # decoded in windows, so the temporary numpy columns stay small for long tracks
+        for start in range(0, len(self.offsets), window):
+            offsets = numpy.frombuffer(self.offsets, dtype=self.offsets.typecode)[start:start + window]
+            sizes = numpy.frombuffer(self.sizes, dtype=self.sizes.typecode)[start:start + window]
+            toc_bytes = data[offsets]
+            second_bytes = data[numpy.minimum(offsets + 1, len(data) - 1)]
+            frame_samples = toc_frame_samples[toc_bytes]
+            if not frame_samples.all():
+                self.check_configs(toc_bytes.tolist())
+
+            frame_counts = toc_frame_counts[toc_bytes]
+            frame_counts = numpy.where(frame_counts == 0, second_bytes & 63, frame_counts)
+            framepackings = toc_bytes & 3
+            cumulative_granules = numpy.cumsum(frame_samples * frame_counts) + last_granule
+            last_granule = int(cumulative_granules[-1])
+
+            self.segment_counts.frombytes((sizes // 255 + 1).astype("L").tobytes())
+            self.framepackings.frombytes(framepackings.astype("B").tobytes())
+            self.paddings.frombytes(((framepackings == 3) & ((second_bytes & 64) != 0)).astype("B").tobytes())
+            self.cumulative_granules.frombytes(cumulative_granules.astype("q").tobytes())
+
+
+    def check_configs(self, toc_bytes):
+        # refuse the whole track before any of its pages is written
+        toc_frame_samples = create_toc_tables()[0]
+        for toc_byte in toc_bytes:
+            if not toc_frame_samples[toc_byte]:
+                get_frame_size(toc_byte >> 3)
+
+
+def get_padded_packet(data, convert, pad_count, pad_count_size):
+    packet = OpusPacket(io.BytesIO(data), len(data))
+    if convert:
+        packet.convert_to_framepacking_three()
+    if pad_count is not None:
+        packet.set_pad_count(pad_count, pad_count_size)
+        packet.data = packet.data + bytes(pad_count)
+    return packet.data
+
+
+class OggPageBuilder:
+    def __init__(self, template_page, page_no, max_size, track, first_packet):
+        self.page = OggPage.from_page(template_page)
+        self.page.page_no = page_no
+        self.max_size = max_size
+        self.track = track
+        self.first_packet = first_packet
+        self.packet_count = 0
+        self.segment_count = 0
+        self.data_size = 0
+
+
+    def get_page_size(self):
+        return 27 + self.segment_count + self.data_size
+
+
+    def fits(self, index):
+        size = self.track.sizes[index]
+        seg_count = self.track.segment_counts[index]
+        if (size + seg_count + self.get_page_size() <= self.max_size) and (self.segment_count + seg_count < 256):
+            return True
+        if not self.packet_count:
+            raise RuntimeError("Opus packet of {} bytes does not fit into a page of {} bytes"
+                               .format(size, self.max_size))
+        return False
+
+
+    def add_packet(self, index):
+        self.packet_count = self.packet_count + 1
+        self.segment_count = self.segment_count + self.track.segment_counts[index]
+        self.data_size = self.data_size + self.track.sizes[index]
+
+
+    def finish(self, base_granule):
+        track = self.track
+        first = self.first_packet
+        end = first + self.packet_count
+        page_size = self.get_page_size()
+        plan = None
+        if page_size != self.max_size:
+            with measure_stage("pad"):
+                plan = plan_padding(track.sizes[first:end], track.framepackings[first:end],
+                                    track.paddings[first:end], self.segment_count, page_size, self.max_size)
+            if build_stats is not None:
+                build_stats.count("padding_bytes", self.max_size - page_size)
+                build_stats.count("framepacking_conversions", sum(plan.convert))
+                build_stats.count("pad_retries", plan.one_byte_count)
+                build_stats.count("pad_search_fallbacks", int(plan.searched))
+        count_stat("packets_repacked", self.packet_count)
+
+        lacing_values = bytearray()
+        packet_starts = array("H")
+        body = bytearray()
+        for i in range(self.packet_count):
+            offset = track.offsets[first + i]
+            data = track.buffer[offset:offset + track.sizes[first + i]]
+            if plan is not None and (plan.convert[i] or plan.pad_counts[i] is not None):
+                data = get_padded_packet(bytes(data), plan.convert[i], plan.pad_counts[i], plan.pad_count_sizes[i])
+            packet_starts.append(len(body))
+            body += data
+            lacing_values += b"\xFF" * (len(data) // 255)
+            lacing_values.append(len(data) % 255)
+
+        page = self.page
+        page.set_packets(lacing_values, packet_starts, body)
+        # the granule position is the running sum of the packet durations of the track
+        page.granule_position = base_granule + track.cumulative_granules[end - 1]
+        with measure_stage("crc"):
+            page.update_checksum()
+        return page
+
+
+def resize_pages(track, max_page_size, first_page_size, template_page, last_granule=0, start_no=2,
+                 set_last_page_flag=False):
+    builder = OggPageBuilder(template_page, start_no, first_page_size, track, 0)
 
-            new_page = OggPage.from_page(template_page)
-            page_no = page_no + 1
-            new_page.page_no = page_no
-            max_size = max_page_size
+    for index in range(len(track.sizes)):
+        if not builder.fits(index):
+            new_page = builder.finish(last_granule)
+            yield new_page
+            builder = OggPageBuilder(template_page, new_page.page_no + 1, max_page_size, track, index)
+        builder.add_packet(index)
 
-    if len(new_page.segments):
+    if builder.packet_count:
         if set_last_page_flag:
-            new_page.page_type = 4
-        new_page.pad(max_size)
-        new_page.correct_values(last_granule)
-        new_pages.append(new_page)
+            builder.page.page_type = 4
+        yield builder.finish(last_granule)
+
 
-    return new_pages
+def resize_stream_pages(chunks, max_page_size, first_page_size, template_page, last_granule=0, start_no=2,
+                        set_last_page_flag=False):
+    # the packets of the page that is still being filled are carried over into the next chunk
+    page_size = first_page_size
+    page_no = start_no
+    builder = None
+    carry = []
+    for packets in chunks:
+        track = OpusTrack(None)
+        with measure_stage("parse"):
+            track.set_packets(carry + packets)
+        base_granule = last_granule
+        builder = OggPageBuilder(template_page, page_no, page_size, track, 0)
+        for index in range(len(track.sizes)):
+            if not builder.fits(index):
+                new_page = builder.finish(base_granule)
+                yield new_page
+                last_granule = new_page.granule_position
+                page_no = new_page.page_no + 1
+                page_size = max_page_size
+                builder = OggPageBuilder(template_page, page_no, page_size, track, index)
+            builder.add_packet(index)
+        carry = track.get_packets(builder.first_packet)
+
+    if builder is not None and builder.packet_count:
+        if set_last_page_flag:
+            builder.page.page_type = 4
+        yield builder.finish(base_granule)
 
 
 def append_to_filename(output_filename, suffix):
@@ -608,30 +1215,470 @@ def append_to_filename(output_filename, suffix):
         return output_filename[:pos] + " " + suffix + output_filename[pos:]
 
 
-def fix_tonie_header(out_file, chapters, timestamp, sha):
-    tonie_header = tonie_header_pb2.TonieHeader()
+def encode_varint(value):
+    result = bytearray()
+    while value > 0x7F:
+        result.append(0x80 | (value & 0x7F))
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def decode_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise RuntimeError("Truncated varint in Tonie header")
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+class TonieHeader:
+    # the protobuf message from tonie_header.proto, encoded by hand: fields are written in field number order and
+    # fields holding their default value are omitted, just like the protobuf runtime does for proto3 messages
+    def __init__(self, dataHash=b"", dataLength=0, timestamp=0, chapterPages=None, padding=b""):
+        self.dataHash = dataHash
+        self.dataLength = dataLength
+        self.timestamp = timestamp
+        self.chapterPages = chapterPages if chapterPages is not None else []
+        self.padding = padding
+
+
+    def serialize_fields(self):
+        result = bytearray()
+        if self.dataHash:
+            result += b"\x0A" + encode_varint(len(self.dataHash)) + self.dataHash
+        if self.dataLength:
+            result += b"\x10" + encode_varint(self.dataLength)
+        if self.timestamp:
+            result += b"\x18" + encode_varint(self.timestamp)
+        if self.chapterPages:
+            packed = b"".join(encode_varint(page) for page in self.chapterPages)
+            result += b"\x22" + encode_varint(len(packed)) + packed
+        return result
+
+
+    def serialize_padded(self, size=0xFFC):
+        # the padding field is sized as if its length took two bytes, which it does for any sane header
+        result = self.serialize_fields()
+        pad = size - len(result) - 3
+        if pad < 0:
+            raise RuntimeError("Tonie header does not fit into {} bytes".format(size))
+        self.padding = bytes(pad)
+        result += b"\x2A" + encode_varint(pad) + self.padding
+        return bytes(result)
 
-    tonie_header.dataHash = sha.digest()
-    tonie_header.dataLength = out_file.seek(0, 1) - 0x1000
-    tonie_header.timestamp = timestamp
 
-    for chapter in chapters:
-        tonie_header.chapterPages.append(chapter)
+    @staticmethod
+    def parse(data):
+        header = TonieHeader()
+        data = memoryview(data)
+        position = 0
+        while position < len(data):
+            key, position = decode_varint(data, position)
+            field = key >> 3
+            wire_type = key & 7
+            if wire_type == 0:
+                value, position = decode_varint(data, position)
+                if field == 2:
+                    header.dataLength = value & 0xFFFFFFFF
+                elif field == 3:
+                    header.timestamp = value & 0xFFFFFFFF
+                elif field == 4:
+                    header.chapterPages.append(value & 0xFFFFFFFF)
+            elif wire_type == 2:
+                length, position = decode_varint(data, position)
+                end = position + length
+                if end > len(data):
+                    raise RuntimeError("Truncated field {} in Tonie header".format(field))
+                if field == 1:
+                    header.dataHash = bytes(data[position:end])
+                elif field == 4:
+                    while position < end:
+                        value, position = decode_varint(data, position)
+                        header.chapterPages.append(value & 0xFFFFFFFF)
+                elif field == 5:
+                    header.padding = bytes(data[position:end])
+                position = end
+            elif wire_type == 1:
+                position += 8
+            elif wire_type == 5:
+                position += 4
+            else:
+                raise RuntimeError("Unsupported wire type {} in Tonie header".format(wire_type))
+        if position > len(data):
+            raise RuntimeError("Truncated Tonie header")
+        return header
 
-    tonie_header.padding = bytes(0x100)
 
-    header = tonie_header.SerializeToString()
-    pad = 0xFFC - len(header) + 0x100
-    tonie_header.padding = bytes(pad)
-    header = tonie_header.SerializeToString()
+def fix_tonie_header(out_file, chapters, timestamp, sha):
+    tonie_header = TonieHeader(sha.digest(), out_file.seek(0, 1) - 0x1000, timestamp, list(chapters))
+    header = tonie_header.serialize_padded()
 
     out_file.seek(0)
-    out_file.write(struct.pack(">L", len(header)))
-    out_file.write(header)
+    out_file.write(struct.pack(">L", len(header)) + header)
+
+
+class BuildStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.tracks = collections.OrderedDict()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_times = os.times()
+
+
+    def set_track(self, track):
+        self.local.track = track
+        with self.lock:
+            if track is not None and track not in self.tracks:
+                self.tracks[track] = {"stages": collections.OrderedDict(), "audio_seconds": 0}
+
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        # nested stages are not counted twice, the outer stage only gets its own time
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append([0.0, 0.0])
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            child_wall, child_cpu = stack.pop()
+            if len(stack):
+                stack[-1][0] = stack[-1][0] + wall
+                stack[-1][1] = stack[-1][1] + cpu
+            self.add_time(stage, wall - child_wall, cpu - child_cpu)
+
+
+    def add_time(self, stage, wall, cpu):
+        track = getattr(self.local, "track", None)
+        with self.lock:
+            add_stage_time(self.stages, stage, wall, cpu)
+            if track is not None:
+                add_stage_time(self.tracks[track]["stages"], stage, wall, cpu)
+
+
+    def get_state(self):
+        with self.lock:
+            return self.stages, self.counters, self.tracks
+
+
+    def merge(self, state):
+        # adds the statistics of a build that ran in another process
+        stages, counters, tracks = state
+        with self.lock:
+            for stage, values in stages.items():
+                add_stage_time(self.stages, stage, values["wall"], values["cpu"], values["calls"])
+            self.counters.update(counters)
+            for track, values in tracks.items():
+                entry = self.tracks.setdefault(track, {"stages": collections.OrderedDict(), "audio_seconds": 0})
+                entry["audio_seconds"] = entry["audio_seconds"] + values["audio_seconds"]
+                for stage, stage_values in values["stages"].items():
+                    add_stage_time(entry["stages"], stage, stage_values["wall"], stage_values["cpu"],
+                                   stage_values["calls"])
+
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters[name] + value
+
+
+    def add_audio(self, seconds):
+        track = getattr(self.local, "track", None)
+        self.count("audio_seconds", seconds)
+        if track is not None:
+            with self.lock:
+                self.tracks[track]["audio_seconds"] = self.tracks[track]["audio_seconds"] + seconds
+
+
+    def get_result(self):
+        wall = time.perf_counter() - self.start_wall
+        times = os.times()
+        child_cpu = (times.children_user - self.start_times.children_user) + \
+                    (times.children_system - self.start_times.children_system)
+        with self.lock:
+            return {
+                "wall": round(wall, 4),
+                "cpu": round(time.process_time() - self.start_cpu, 4),
+                "child_cpu": round(child_cpu, 4),
+                "realtime_factor": round(self.counters["audio_seconds"] / wall, 2) if wall else None,
+                "stages": {name: {"wall": round(values["wall"], 4), "cpu": round(values["cpu"], 4),
+                                  "calls": values["calls"]} for name, values in self.stages.items()},
+                "counters": dict(self.counters),
+                "tracks": [{"track": track, "audio_seconds": values["audio_seconds"],
+                            "stages": {name: {"wall": round(stage["wall"], 4), "cpu": round(stage["cpu"], 4)}
+                                       for name, stage in values["stages"].items()}}
+                           for track, values in self.tracks.items()]
+            }
+
+
+    def print_summary(self):
+        result = self.get_result()
+        print("")
+        print("[ii] Build statistics: {:.2f}s wall, {:.2f}s cpu, {:.2f}s child process cpu, {}x realtime"
+              .format(result["wall"], result["cpu"], result["child_cpu"], result["realtime_factor"]))
+        print("  {:12s} {:>10s} {:>10s} {:>8s}".format("stage", "wall (s)", "cpu (s)", "calls"))
+        for name, values in result["stages"].items():
+            print("  {:12s} {:10.3f} {:10.3f} {:8d}".format(name, values["wall"], values["cpu"], values["calls"]))
+        for name in sorted(result["counters"]):
+            print("  {}: {}".format(name.replace("_", " ").capitalize(), result["counters"][name]))
+        for track in result["tracks"]:
+            print("  {} ({}): {}".format(track["track"], granule_to_time_string(track["audio_seconds"]),
+                                         ", ".join("{} {:.3f}s".format(name, values["wall"])
+                                                   for name, values in track["stages"].items())))
+
+
+def add_stage_time(stages, stage, wall, cpu, calls=1):
+    values = stages.setdefault(stage, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+    values["wall"] = values["wall"] + wall
+    values["cpu"] = values["cpu"] + cpu
+    values["calls"] = values["calls"] + calls
+
+
+build_stats = None
+no_build_stats = contextlib.nullcontext()  # reentrant, one instance serves all disabled measurements
+
+
+def enable_build_stats():
+    global build_stats
+    build_stats = BuildStats()
+    return build_stats
+
+
+def measure_stage(stage):
+    if build_stats is None:
+        return no_build_stats
+    return build_stats.measure(stage)
+
+
+def count_stat(name, value=1):
+    if build_stats is not None:
+        build_stats.count(name, value)
+
+
+def report_build_stats(stats, summary=True, json_filename=None):
+    if stats is None:
+        return
+    if summary:
+        stats.print_summary()
+    if json_filename:
+        output = json.dumps(stats.get_result(), indent=2)
+        if json_filename == "-":
+            print(output)
+        else:
+            with open(json_filename, "w") as json_file:
+                json_file.write(output + "\n")
+
+
+def open_input_file(fname, bitrate, cbr, ffmpeg, opusenc, cache=None, output="memory", copyable=None):
+    # copyable is the result of probe_opus_file if the caller already probed the file
+    if build_stats is not None:
+        build_stats.set_track(fname)
+    if fname.lower().startswith("text:"):
+        with measure_stage("text2speech"):
+            return get_t2s_tempfile(ffmpeg, opusenc, fname[5:], bitrate, not cbr, cache)
+
+    if copyable is None:
+        copyable = probe_opus_file(fname)
+    if copyable:
+        count_stat("copied_tracks")
+        return open(fname, "rb")
+    handle = open_remuxed_file(fname, ffmpeg, output)
+    if handle is not None:
+        return handle
+    with measure_stage("transcode"):
+        return get_opus_tempfile(ffmpeg, opusenc, fname, bitrate, not cbr, cache, output)
+
+
+def probe_opus_file(fname):
+    # opus streams of stereo CELT packets are repacked as they are, everything else gets transcoded
+    if fname.lower().startswith("text:") or os.path.splitext(fname)[1].lower() not in OGG_EXTENSIONS:
+        return False
+    with measure_stage("probe"):
+        return is_copyable_opus_file(fname)
+
+
+def open_remuxed_file(fname, ffmpeg, output="memory"):
+    if os.path.splitext(fname)[1].lower() not in MATROSKA_EXTENSIONS:
+        return None
+    with measure_stage("remux"):
+        handle = get_remuxed_tempfile(ffmpeg, fname, output)
+    if handle is not None:
+        count_stat("remuxed_tracks")
+    return handle
+
+
+def is_copyable_opus(in_file):
+    toc_frame_samples = create_toc_tables()[0]
+    try:
+        first_page, second_page = read_first_and_second_page(in_file)
+        unpacked = struct.unpack("<8sBBHLhB", bytes(first_page.body[:19]))
+        if unpacked[0] != b"OpusHead" or unpacked[1] != 1 or unpacked[2] != 2 or unpacked[6] != 0:
+            return False
+        packet_size = 0
+        for page in iter_remaining_pages(in_file):
+            if page.serial_no != first_page.serial_no:
+                return False
+            body = page.body
+            starts = page.packet_starts[1:] if page.page_type & 1 else page.packet_starts
+            if not all(start < len(body) and toc_frame_samples[body[start]] for start in starts):
+                return False
+            # every packet has to fit into the first audio page of a Tonie file (0xE00 bytes) on its own
+            for length in page.lacing_values:
+                packet_size = packet_size + length
+                if length < 255:
+                    if 27 + packet_size // 255 + 1 + packet_size > 0xE00:
+                        return False
+                    packet_size = 0
+    except (RuntimeError, struct.error, IndexError):
+        return False
+    return True
+
+
+def is_copyable_opus_file(fname):
+    with open(fname, "rb") as handle:
+        in_file = MappedFile(handle)
+        try:
+            return is_copyable_opus(in_file)
+        finally:
+            in_file.close()
+
+
+def iter_input_files(input_files, bitrate, cbr, ffmpeg, opusenc, jobs=1, cache=None, stream=False):
+    prefetch_t2s(input_files, bitrate, cbr, ffmpeg, opusenc, cache)
+    if jobs == 1:
+        for fname in input_files:
+            yield fname, open_input_file(fname, bitrate, cbr, ffmpeg, opusenc, cache,
+                                         "stream" if stream else "memory")
+        return
+
+    # transcode up to jobs tracks ahead, but hand them out strictly in list order. When streaming,
+    # the tracks that are encoded ahead wait in temporary files instead of memory
+    output = "disk" if stream else "memory"
+    remaining = iter(input_files)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for fname in itertools.islice(remaining, jobs):
+                pending.append((fname, executor.submit(open_input_file, fname, bitrate, cbr, ffmpeg, opusenc,
+                                                       cache, output)))
+            while pending:
+                fname, future = pending.popleft()
+                handle = future.result()
+                for next_fname in itertools.islice(remaining, 1):
+                    pending.append((next_fname, executor.submit(open_input_file, next_fname, bitrate, cbr,
+                                                                ffmpeg, opusenc, cache, output)))
+                yield fname, handle
+        finally:
+            for _, future in pending:
+                future.cancel()
+            for _, future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    future.result().close()
+
+
+def write_tracks(out_file, input_files, timestamp, sha1, chapters, bitrate, cbr, ffmpeg, opusenc, jobs=1,
+                 cache=None, template_page=None, total_granule=0, next_page_no=2, input_handles=None, verbose=True,
+                 stream=False):
+    max_size = 0x1000
+    other_size = 0xE00
+    last_track = False
+
+    pad_len = math.ceil(math.log(len(input_files) + 1, 10))
+    format_string = "[{{:0{}d}}/{:0{}d}] {{}}".format(pad_len, len(input_files), pad_len)
+
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    if input_handles is None:
+        input_handles = iter_input_files(input_files, bitrate, cbr, ffmpeg, opusenc, jobs, cache, stream)
+
+    for index, (fname, handle) in enumerate(input_handles):
+        if verbose:
+            print(format_string.format(index + 1, fname))
+        if build_stats is not None:
+            build_stats.set_track(fname)
+        if index == len(input_files) - 1:
+            last_track = True
+
+        try:
+            if isinstance(handle, EncoderStream):
+                # pages are packed as they come out of the encoder, only the current chunk is kept in memory
+                pages = iter_stream_pages(handle)
+                first_page, second_page = read_stream_header_pages(pages)
+                first_audio_page = next(pages, None)
+            else:
+                in_file = MappedFile(handle)
+                first_page, second_page = read_first_and_second_page(in_file)
+                with measure_stage("parse"):
+                    track = OpusTrack(in_file)
+                first_audio_page = track.first_page if len(track.sizes) else None
+
+            if next_page_no == 2:
+                write_first_and_second_page(first_page, second_page, out_file, timestamp, sha1)
+            else:
+                other_size = max_size
+                check_identification_header(first_page)
+            if first_audio_page is None:
+                raise RuntimeError("No audio pages found in {}".format(fname))
+
+            if template_page is None:
+                template_page = OggPage.from_page(first_audio_page)
+                template_page.serial_no = timestamp
+
+            if next_page_no == 2:
+                chapters.append(0)
+            else:
+                chapters.append(next_page_no)
+
+            if isinstance(handle, EncoderStream):
+                new_pages = resize_stream_pages(iter_stream_packets(itertools.chain([first_audio_page], pages)),
+                                                max_size, other_size, template_page, total_granule, next_page_no,
+                                                last_track)
+            else:
+                new_pages = resize_pages(track, max_size, other_size, template_page,
+                                         total_granule, next_page_no, last_track)
+
+            last_page = None
+            with measure_stage("pack"):
+                for new_page in new_pages:
+                    new_page.write_page(out_file, sha1)
+                    last_page = new_page
+            count_stat("pages_written", last_page.page_no + 1 - next_page_no)
+            if build_stats is not None:
+                build_stats.add_audio((last_page.granule_position - total_granule) / (SAMPLE_RATE_KHZ * 1000))
+            total_granule = last_page.granule_position
+            next_page_no = last_page.page_no + 1
+        finally:
+            handle.close()
+    return total_granule, next_page_no
+
+
+def get_build_result(output_file, timestamp, sha1, chapters, total_granule, page_count):
+    return {
+        "file": output_file,
+        "timestamp": timestamp,
+        "sha1": sha1.hexdigest().upper(),
+        "chapters": list(chapters),
+        "page_count": page_count,
+        "total_time": total_granule / (SAMPLE_RATE_KHZ * 1000)
+    }
 
 
 def create_tonie_file(output_file, input_files, no_tonie_header=False, user_timestamp=None,
-                      bitrate=96, cbr=False, ffmpeg='ffmpeg', opusenc='opusenc'):
+                      bitrate=96, cbr=False, ffmpeg='ffmpeg', opusenc='opusenc', jobs=1, cache=None,
+                      input_handles=None, verbose=True, stream=False):
     with open(output_file, "wb") as out_file:
         if not no_tonie_header:
             out_file.write(bytearray(0x1000))
@@ -645,72 +1692,360 @@ def create_tonie_file(output_file, input_files, no_tonie_header=False, user_time
             timestamp = int(time.time())
 
         sha1 = hashlib.sha1()
-
-        template_page = None
         chapters = []
-        total_granule = 0
-        next_page_no = 2
-        max_size = 0x1000
-        other_size = 0xE00
-        last_track = False
+        total_granule, page_count = write_tracks(out_file, input_files, timestamp, sha1, chapters, bitrate, cbr,
+                                                 ffmpeg, opusenc, jobs, cache, input_handles=input_handles,
+                                                 verbose=verbose, stream=stream)
 
-        pad_len = math.ceil(math.log(len(input_files) + 1, 10))
-        format_string = "[{{:0{}d}}/{:0{}d}] {{}}".format(pad_len, len(input_files), pad_len)
+        if not no_tonie_header:
+            fix_tonie_header(out_file, chapters, timestamp, sha1)
+    return get_build_result(output_file, timestamp, sha1, chapters, total_granule, page_count)
+
+
+class SharedTranscoder:
+    def __init__(self, executor, tmp_dir, ffmpeg, opusenc, cache=None):
+        self.executor = executor
+        self.tmp_dir = tmp_dir
+        self.ffmpeg = ffmpeg
+        self.opusenc = opusenc
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.entries = {}
+
+
+    def get_key(self, fname, bitrate, cbr):
+        if fname.lower().startswith("text:"):
+            return fname, bitrate, cbr
+        return os.path.abspath(fname), bitrate, cbr
+
+
+    def add(self, fname, bitrate, cbr):
+        # every input is transcoded once, no matter how many targets use it
+        key = self.get_key(fname, bitrate, cbr)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                future = self.executor.submit(self.transcode, fname, bitrate, cbr)
+                entry = self.entries[key] = [future, 0]
+            entry[1] = entry[1] + 1
+
+
+    def transcode(self, fname, bitrate, cbr):
+        if build_stats is not None:
+            build_stats.set_track(fname)
+        copyable = probe_opus_file(fname)
+        if copyable:
+            return fname
+        with open_input_file(fname, bitrate, cbr, self.ffmpeg, self.opusenc, self.cache, "disk",
+                             copyable) as handle:
+            with tempfile.NamedTemporaryFile(dir=self.tmp_dir, suffix=".opus", delete=False) as tmp_file:
+                shutil.copyfileobj(handle, tmp_file, COPY_BUFFER_SIZE)
+        return tmp_file.name
+
+
+    def release(self, input_files, bitrate, cbr):
+        for fname in input_files:
+            self.release_key(self.get_key(fname, bitrate, cbr))
+
+
+    def release_key(self, key):
+        with self.lock:
+            entry = self.entries[key]
+            entry[1] = entry[1] - 1
+            if entry[1] > 0:
+                return
+            del self.entries[key]
+        future = entry[0]
+        if future.cancel() or future.exception() is not None:
+            return
+        path = future.result()
+        if os.path.dirname(path) == self.tmp_dir:
+            os.remove(path)
+
+
+    def get_paths(self, input_files, bitrate, cbr):
+        with self.lock:
+            futures = [self.entries[self.get_key(fname, bitrate, cbr)][0] for fname in input_files]
+        return [future.result() for future in futures]
+
+
+    def cancel(self):
+        with self.lock:
+            for future, _ in self.entries.values():
+                future.cancel()
+
+
+def read_manifest(filename, bitrate=96, cbr=False):
+    with open(filename) as manifest_file:
+        manifest = json.load(manifest_file)
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    bitrate = manifest.get("bitrate", bitrate)
+    cbr = manifest.get("cbr", cbr)
+
+    targets = []
+    for index, entry in enumerate(manifest.get("tonies", [])):
+        if "output" not in entry:
+            raise RuntimeError("Manifest entry {} has no output".format(index + 1))
+        if "tracks" in entry:
+            input_files = [fname if fname.startswith("text:") else os.path.join(base_dir, fname)
+                           for fname in entry["tracks"]]
+        elif "source" in entry:
+            source = os.path.join(base_dir, entry["source"])
+            if os.path.isdir(source):
+                source = os.path.join(source, "*")
+            input_files = get_input_files(source)
+        else:
+            raise RuntimeError("Manifest entry {} ({}) has neither tracks nor source".format(index + 1,
+                                                                                          entry["output"]))
+        if len(input_files) == 0:
+            raise RuntimeError("Manifest entry {} ({}) has no input files".format(index + 1, entry["output"]))
+        timestamp = entry.get("timestamp")
+        targets.append({
+            "output": os.path.join(base_dir, entry["output"]),
+            "input_files": input_files,
+            "timestamp": None if timestamp is None else str(timestamp),
+            "bitrate": entry.get("bitrate", bitrate),
+            "cbr": entry.get("cbr", cbr),
+            "no_tonie_header": entry.get("no_tonie_header", False)
+        })
+    if len(targets) == 0:
+        raise RuntimeError("Manifest {} lists no Tonie files".format(filename))
+    return targets
+
+
+def assemble_manifest_target(target, paths, collect_stats=False):
+    stats = enable_build_stats() if collect_stats else None
+    input_handles = ((fname, open(path, "rb")) for fname, path in zip(target["input_files"], paths))
+    try:
+        os.makedirs(os.path.dirname(target["output"]), exist_ok=True)
+        create_tonie_file(target["output"], target["input_files"], target["no_tonie_header"], target["timestamp"],
+                          target["bitrate"], target["cbr"], input_handles=input_handles, verbose=False)
+    except BaseException:
+        if os.path.exists(target["output"]):
+            os.remove(target["output"])
+        raise
+    return None if stats is None else stats.get_state()
+
+
+def build_manifest_target(transcoder, assemble_executor, target):
+    try:
+        paths = transcoder.get_paths(target["input_files"], target["bitrate"], target["cbr"])
+        state = assemble_executor.submit(assemble_manifest_target, target, paths, build_stats is not None).result()
+        if state is not None:
+            build_stats.merge(state)
+    finally:
+        transcoder.release(target["input_files"], target["bitrate"], target["cbr"])
+
+
+def build_manifest(targets, ffmpeg='ffmpeg', opusenc='opusenc', jobs=0, cache=None, crc_backend="zlib"):
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    pad_len = math.ceil(math.log(len(targets) + 1, 10))
+    format_string = "[{{:0{}d}}/{:0{}d}] {{}}{{}}".format(pad_len, len(targets), pad_len)
+
+    failed = 0
+    # one transcoding pool for all targets, each target is packed and hashed in a worker process as soon as its
+    # tracks are done. The workers are spawned, so they do not inherit the pipes of running encoders
+    with tempfile.TemporaryDirectory(prefix="opus2tonie-") as tmp_dir, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as transcode_executor, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(targets)),
+                                                   mp_context=multiprocessing.get_context("spawn"),
+                                                   initializer=set_crc_backend,
+                                                   initargs=(crc_backend,)) as assemble_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=min(jobs, len(targets))) as build_executor:
+        transcoder = SharedTranscoder(transcode_executor, tmp_dir, ffmpeg, opusenc, cache)
+        futures = []
+        try:
+            for target in targets:
+                prefetch_t2s(target["input_files"], target["bitrate"], target["cbr"], ffmpeg, opusenc, cache)
+            for target in targets:
+                for fname in target["input_files"]:
+                    transcoder.add(fname, target["bitrate"], target["cbr"])
+            futures = [build_executor.submit(build_manifest_target, transcoder, assemble_executor, target)
+                       for target in targets]
+            for index, (target, future) in enumerate(zip(targets, futures)):
+                try:
+                    future.result()
+                    print(format_string.format(index + 1, target["output"], ""))
+                except Exception as error:
+                    failed = failed + 1
+                    print(format_string.format(index + 1, target["output"], " failed: {}".format(error)))
+        finally:
+            for future in futures:
+                future.cancel()
+            transcoder.cancel()
+    return failed == 0
+
+
+def find_last_page(in_file, start):
+    end = in_file.size
+    position = in_file.data.rfind(OGG_PAGE_SYNC, start, end)
+    while position != -1:
+        in_file.seek(position)
+        try:
+            page = OggPage(in_file)
+        except (RuntimeError, struct.error):
+            page = None
+        # a sync word inside the audio data does not yield a page ending at eof with a valid checksum
+        if page is not None and in_file.tell() == end and page.calc_checksum() == page.checksum:
+            in_file.seek(position)
+            return page
+        position = in_file.data.rfind(OGG_PAGE_SYNC, start, position)
+    raise RuntimeError("Last ogg page not found")
+
+
+def append_to_tonie_file(output_file, input_files, bitrate=96, cbr=False, ffmpeg='ffmpeg', opusenc='opusenc',
+                         jobs=1, cache=None, verbose=True, stream=False):
+    with open(output_file, "r+b") as out_file:
+        in_file = MappedFile(out_file)
+        header_size, tonie_header = read_tonie_header(in_file)
+        audio_start = 4 + header_size
+
+        last_page = find_last_page(in_file, max(audio_start, in_file.size - 0x1000))
+        last_page_offset = in_file.tell()
+
+        # hash the existing audio data in one pass, verifying it before anything gets changed
+        sha1 = hashlib.sha1(in_file.buffer[audio_start:last_page_offset])
+        check_sha1 = sha1.copy()
+        check_sha1.update(in_file.buffer[last_page_offset:])
+        if check_sha1.digest() != tonie_header.dataHash:
+            raise RuntimeError("SHA1 hash of {} does not match its header, refusing to append".format(output_file))
+
+        # the former last page does not end the stream anymore
+        last_page.page_type = last_page.page_type & ~4
+        last_page.checksum = last_page.calc_checksum()
+        patched_page = io.BytesIO()
+        last_page.write_page(patched_page, sha1)
+
+        template_page = OggPage.from_page(last_page)
+        template_page.serial_no = tonie_header.timestamp
+        total_granule = last_page.granule_position
+        next_page_no = last_page.page_no + 1
+        chapters = list(tonie_header.chapterPages)
+        original_header = bytes(in_file.buffer[:audio_start])
+        original_last_page = bytes(in_file.buffer[last_page_offset:])
+        in_file.close()
+
+        try:
+            out_file.seek(last_page_offset)
+            out_file.write(patched_page.getvalue())
+            total_granule, page_count = write_tracks(out_file, input_files, tonie_header.timestamp, sha1, chapters,
+                                                     bitrate, cbr, ffmpeg, opusenc, jobs, cache, template_page,
+                                                     total_granule, next_page_no, verbose=verbose, stream=stream)
+            fix_tonie_header(out_file, chapters, tonie_header.timestamp, sha1)
+        except BaseException:
+            # a failed append leaves the file as it was before
+            out_file.seek(0)
+            out_file.write(original_header)
+            out_file.seek(last_page_offset)
+            out_file.write(original_last_page)
+            out_file.truncate()
+            raise
+    return get_build_result(output_file, tonie_header.timestamp, sha1, chapters, total_granule, page_count)
+
+
+def parse_tonie_header(data):
+    if len(data) < 4:
+        raise RuntimeError("Tonie header not found")
+    header_size = struct.unpack_from(">L", data)[0]
+    if len(data) < 4 + header_size:
+        raise RuntimeError("Tonie header is truncated")
+    return header_size, TonieHeader.parse(memoryview(data)[4:4 + header_size])
+
+
+def read_tonie_header(in_file):
+    # the header normally fills exactly the first 4 KiB, so a single read is enough
+    start = in_file.tell()
+    data = in_file.read(0x1000)
+    if len(data) >= 4:
+        header_size = struct.unpack_from(">L", data)[0]
+        if 4 + header_size > len(data):
+            data += in_file.read(4 + header_size - len(data))
+    header_size, tonie_header = parse_tonie_header(data)
+    in_file.seek(start + 4 + header_size)
+    return header_size, tonie_header
+
+
+class TonieReader:
+    def __init__(self, in_file):
+        self.in_file = in_file
+        in_file.seek(0)
+        self.header_size, self.tonie_header = read_tonie_header(in_file)
+        self.audio_start = 4 + self.header_size
+        self.first_page = self.read_page_at(self.audio_start)
+        self.sample_rate = struct.unpack_from("<L", self.first_page.segments[0].data, 12)[0]
+        self.last_page = None
+
+
+    def get_page_offset(self, page_no):
+        # audio pages are aligned: pages 0 and 1 share the first 0x200 bytes, page 2 fills up the first block
+        if page_no == 2:
+            return self.audio_start + 0x200
+        return self.audio_start + (page_no - 2) * 0x1000
+
+
+    def read_page_at(self, offset):
+        if offset + 27 > self.in_file.size or self.in_file.buffer[offset:offset + 5] != OGG_PAGE_SYNC:
+            raise RuntimeError("No ogg page at offset 0x{:X}".format(offset))
+        self.in_file.seek(offset)
+        return OggPage(self.in_file)
+
+
+    def read_page(self, page_no):
+        if page_no == 0:
+            return self.first_page
+        if page_no == 1:
+            self.in_file.seek(self.audio_start)
+            OggPage(self.in_file)
+            page = self.read_page_at(self.in_file.tell())
+        else:
+            page = self.read_page_at(self.get_page_offset(page_no))
+        if page.page_no != page_no:
+            raise RuntimeError("Found page {} instead of page {}, file is not aligned".format(page.page_no, page_no))
+        return page
 
-        for index in range(len(input_files)):
-            fname = input_files[index]
-            print(format_string.format(index + 1, fname))
-            if index == len(input_files) - 1:
-                last_track = True
 
-            if fname.lower().endswith(".opus"):
-                handle = open(fname, "rb")
-            elif fname.lower().startswith("text:"):
-                handle = get_t2s_tempfile(ffmpeg, opusenc, fname[5:], bitrate, not cbr)
-            else:
-                handle = get_opus_tempfile(ffmpeg, opusenc, fname, bitrate, not cbr)
+    def get_last_page(self):
+        if self.last_page is None:
+            self.last_page = find_last_page(self.in_file, max(self.audio_start, self.in_file.size - 0x1000))
+        return self.last_page
 
-            try:
-                if next_page_no == 2:
-                    copy_first_and_second_page(handle, out_file, timestamp, sha1)
-                else:
-                    other_size = max_size
-                    skip_first_two_pages(handle)
 
-                pages = read_all_remaining_pages(handle)
+    def get_page_count(self):
+        return self.get_last_page().page_no + 1
 
-                if template_page is None:
-                    template_page = OggPage.from_page(pages[0])
-                    template_page.serial_no = timestamp
 
-                if next_page_no == 2:
-                    chapters.append(0)
-                else:
-                    chapters.append(next_page_no)
+    def get_chapter_granules(self):
+        chapter_granules = []
+        for page_no in self.tonie_header.chapterPages:
+            if page_no == 0:
+                chapter_granules.append(0)
+            elif page_no > 1:
+                chapter_granules.append(self.read_page(page_no).granule_position)
+        return chapter_granules
 
-                new_pages = resize_pages(pages, max_size, other_size, template_page,
-                                         total_granule, next_page_no, last_track)
 
-                for new_page in new_pages:
-                    new_page.write_page(out_file, sha1)
-                last_page = new_pages[len(new_pages) - 1]
-                total_granule = last_page.granule_position
-                next_page_no = last_page.page_no + 1
-            finally:
-                handle.close()
+    def find_page(self, granule):
+        # binary search for the first audio page ending at or after the given granule position
+        low = 2
+        high = self.get_last_page().page_no
+        while low < high:
+            middle = (low + high) // 2
+            if self.read_page(middle).granule_position < granule:
+                low = middle + 1
+            else:
+                high = middle
+        return self.read_page(low)
 
-        if not no_tonie_header:
-            fix_tonie_header(out_file, chapters, timestamp, sha1)
 
+    def get_page_at_time(self, seconds):
+        return self.find_page(int(seconds * self.sample_rate))
 
-def get_header_info(in_file):
-    tonie_header = tonie_header_pb2.TonieHeader()
-    header_size = struct.unpack(">L", in_file.read(4))[0]
-    tonie_header = tonie_header.FromString(in_file.read(header_size))
 
-    sha1sum = hashlib.sha1(in_file.read())
+def get_header_info(in_file):
+    header_size, tonie_header = read_tonie_header(in_file)
 
-    file_size = in_file.tell()
+    file_size = in_file.seek(0, 2)
     in_file.seek(4 + header_size)
     audio_size = file_size - in_file.tell()
 
@@ -731,34 +2066,76 @@ def get_header_info(in_file):
         raise RuntimeError("Second ogg page not found")
     OggPage(in_file)
 
-    return header_size, tonie_header, file_size, audio_size, sha1sum, opus_head_found, \
+    return header_size, tonie_header, file_size, audio_size, opus_head_found, \
            opus_version, channel_count, sample_rate, bitstream_serial_no
 
 
+def check_page(in_file, page, offset, last_page):
+    data = bytearray(in_file.buffer[offset:in_file.tell()])
+    data[22:26] = bytes(4)
+    if crc_function(data) != page.checksum:
+        return "checksum mismatch"
+    expected_page_no = 0 if last_page is None else last_page.page_no + 1
+    if page.page_no != expected_page_no:
+        return "page number {} instead of {}".format(page.page_no, expected_page_no)
+    if last_page is not None and page.granule_position < last_page.granule_position:
+        return "granule position {} is lower than {} of the previous page".format(page.granule_position,
+                                                                                 last_page.granule_position)
+    return None
+
+
 def get_audio_info(in_file, sample_rate, tonie_header, header_size):
+    # single pass over the mapped audio data: hash it, check every page and collect the chapter granules
+    audio_start = 4 + header_size
+    chapter_pages = set(tonie_header.chapterPages)
     chapter_granules = []
-    if 0 in tonie_header.chapterPages:
+    if 0 in chapter_pages:
         chapter_granules.append(0)
 
-    alignment_okay = in_file.tell() == (512 + 4 + header_size)
+    sha1 = hashlib.sha1()
+    hashed = audio_start
+    alignment_okay = True
     page_size_okay = True
-    page_count = 2
+    page_error = None
+    page_count = 0
 
     page = None
+    in_file.seek(audio_start)
+    expected_offset = audio_start
     found = OggPage.seek_to_page_header(in_file)
     while found:
+        offset = in_file.tell()
+        if page_error is None and offset != expected_offset:
+            page_error = (expected_offset, "expected an ogg page")
+        try:
+            next_page = OggPage(in_file)
+        except (RuntimeError, struct.error) as error:
+            if page_error is None:
+                page_error = (offset, str(error))
+            break
+        if page_error is None:
+            problem = check_page(in_file, next_page, offset, page)
+            if problem is not None:
+                page_error = (offset, "page {}: {}".format(next_page.page_no, problem))
+
+        if page is not None and page_count > 3 and page.get_page_size() != 0x1000:
+            page_size_okay = False
+        page = next_page
         page_count = page_count + 1
-        page = OggPage(in_file)
-
-        found = OggPage.seek_to_page_header(in_file)
-        if found and in_file.tell() % 0x1000 != 0:
+        if (page_count == 3 and offset != audio_start + 0x200) or (page_count > 3 and offset % 0x1000 != 0):
             alignment_okay = False
-
-        if page_size_okay and page_count > 3 and page.get_page_size() != 0x1000 and found:
-            page_size_okay = False
-        if page.page_no in tonie_header.chapterPages:
+        if page_count > 2 and page.page_no in chapter_pages:
             chapter_granules.append(page.granule_position)
 
+        expected_offset = in_file.tell()
+        if expected_offset - hashed >= HASH_CHUNK_SIZE:
+            sha1.update(in_file.buffer[hashed:expected_offset])
+            hashed = expected_offset
+        found = OggPage.seek_to_page_header(in_file)
+    sha1.update(in_file.buffer[hashed:in_file.size])
+
+    if page is None:
+        raise RuntimeError("No ogg pages found")
     chapter_granules.append(page.granule_position)
 
     chapter_times = []
@@ -768,7 +2145,23 @@ def get_audio_info(in_file, sample_rate, tonie_header, header_size):
 
     total_time = page.granule_position / sample_rate
 
-    return page_count, alignment_okay, page_size_okay, total_time, chapter_times
+    return page_count, alignment_okay, page_size_okay, page_error, sha1, total_time, chapter_times
+
+
+def get_quick_audio_info(in_file, sample_rate):
+    reader = TonieReader(in_file)
+    last_page = reader.get_last_page()
+    chapter_granules = reader.get_chapter_granules()
+    chapter_granules.append(last_page.granule_position)
+
+    chapter_times = []
+    for i in range(1, len(chapter_granules)):
+        length = chapter_granules[i] - chapter_granules[i - 1]
+        chapter_times.append(granule_to_time_string(length, sample_rate))
+
+    total_time = last_page.granule_position / sample_rate
+
+    return reader.get_page_count(), total_time, chapter_times
 
 
 def format_time(ts):
@@ -779,55 +2172,170 @@ def format_hex(data):
     return "".join(format(x, "02X") for x in data)
 
 
-def check_tonie_file(filename):
-    with open(filename, "rb") as in_file:
-        header_size, tonie_header, file_size, audio_size, sha1, opus_head_found, \
+def get_tonie_file_info(filename, quick=False):
+    info = {"file": filename}
+    with open(filename, "rb") as raw_file:
+        in_file = MappedFile(raw_file)
+        header_size, tonie_header, file_size, audio_size, opus_head_found, \
         opus_version, channel_count, sample_rate, bitstream_serial_no = get_header_info(in_file)
 
-        page_count, alignment_okay, page_size_okay, total_time, \
-        chapters = get_audio_info(in_file, sample_rate, tonie_header, header_size)
-
-    hash_ok = tonie_header.dataHash == sha1.digest()
-    timestamp_ok = tonie_header.timestamp == bitstream_serial_no
-    audio_size_ok = tonie_header.dataLength == audio_size
-    opus_ok = opus_head_found and \
-              opus_version == 1 and \
-              (sample_rate == 48000 or sample_rate == 44100) and \
-              channel_count == 2
-
-    all_ok = hash_ok and \
-             timestamp_ok and \
-             opus_ok and \
-             alignment_okay and \
-             page_size_okay
-
-    print("[{}] SHA1 hash: 0x{}".format("OK" if hash_ok else "NOT OK", format_hex(tonie_header.dataHash)))
-    if not hash_ok:
-        print("            actual: 0x{}".format(sha1.hexdigest().upper()))
-    print("[{}] Timestamp: [0x{:X}] {}".format("OK" if timestamp_ok else "NOT OK", tonie_header.timestamp,
-                                               format_time(tonie_header.timestamp)))
-    if not timestamp_ok:
-        print("   bitstream serial: 0x{:X}".format(bitstream_serial_no))
-    print("[{}] Opus data length: {} bytes (~{:2.0f} kbps)".format("OK" if audio_size_ok else "NOT OK",
-                                                                   tonie_header.dataLength,
-                                                                   (audio_size * 8) / 1024 / total_time))
-    if not audio_size_ok:
-        print("     actual: {} bytes".format(audio_size))
+        if quick:
+            try:
+                page_count, total_time, chapters = get_quick_audio_info(in_file, sample_rate)
+            except (RuntimeError, struct.error) as error:
+                # fall back to reading every page when the file is not laid out as expected
+                info["quick_error"] = str(error)
+                quick = False
+        if not quick:
+            page_count, alignment_okay, page_size_okay, page_error, sha1, total_time, \
+            chapters = get_audio_info(in_file, sample_rate, tonie_header, header_size)
+
+    info["verified"] = not quick
+    info["hash"] = format_hex(tonie_header.dataHash)
+    info["timestamp"] = tonie_header.timestamp
+    info["timestamp_ok"] = tonie_header.timestamp == bitstream_serial_no
+    info["bitstream_serial"] = bitstream_serial_no
+    info["file_size"] = file_size
+    info["data_length"] = tonie_header.dataLength
+    info["audio_size"] = audio_size
+    info["audio_size_ok"] = tonie_header.dataLength == audio_size
+    info["opus_head_ok"] = opus_head_found and opus_version == 1
+    info["opus_ok"] = info["opus_head_ok"] and \
+                      (sample_rate == 48000 or sample_rate == 44100) and \
+                      channel_count == 2
+    info["channels"] = channel_count
+    info["sample_rate"] = sample_rate
+    info["page_count"] = page_count
+    info["total_time"] = total_time
+    info["chapter_times"] = chapters
+    info["valid"] = info["timestamp_ok"] and info["opus_ok"]
+    if quick and info["valid"]:
+        # the hash and the pages were not read, so the file is not known to be valid
+        info["valid"] = None
+    if not quick:
+        info["actual_hash"] = sha1.hexdigest().upper()
+        info["hash_ok"] = tonie_header.dataHash == sha1.digest()
+        info["alignment_ok"] = alignment_okay
+        info["page_size_ok"] = page_size_okay
+        info["page_error"] = None if page_error is None else \
+            "Broken page at offset 0x{:X}: {}".format(page_error[0], page_error[1])
+        info["valid"] = info["valid"] and \
+                        info["hash_ok"] and \
+                        alignment_okay and \
+                        page_size_okay and \
+                        page_error is None
+    return info
+
+
+def print_tonie_file_info(info):
+    if "quick_error" in info:
+        print("[ii] Quick check not possible: {}".format(info["quick_error"]))
+    if not info["verified"]:
+        print("[ii] SHA1 hash: 0x{} (not verified)".format(info["hash"]))
+    else:
+        print("[{}] SHA1 hash: 0x{}".format("OK" if info["hash_ok"] else "NOT OK", info["hash"]))
+        if not info["hash_ok"]:
+            print("            actual: 0x{}".format(info["actual_hash"]))
+    print("[{}] Timestamp: [0x{:X}] {}".format("OK" if info["timestamp_ok"] else "NOT OK", info["timestamp"],
+                                               format_time(info["timestamp"])))
+    if not info["timestamp_ok"]:
+        print("   bitstream serial: 0x{:X}".format(info["bitstream_serial"]))
+    print("[{}] Opus data length: {} bytes (~{:2.0f} kbps)".format("OK" if info["audio_size_ok"] else "NOT OK",
+                                                                   info["data_length"],
+                                                                   (info["audio_size"] * 8) / 1024 /
+                                                                   info["total_time"]))
+    if not info["audio_size_ok"]:
+        print("     actual: {} bytes".format(info["audio_size"]))
 
     print("[{}] Opus header {}OK || {} channels || {:2.1f} kHz || {} Ogg pages"
-          .format("OK" if opus_ok else "NOT OK", "" if opus_head_found and opus_version == 1 else "NOT ",
-                  channel_count, sample_rate / 1000, page_count))
-    print("[{}] Page alignment {}OK and size {}OK"
-          .format("OK" if alignment_okay and page_size_okay else "NOT OK", "" if alignment_okay else "NOT ",
-                  "" if page_size_okay else "NOT "))
+          .format("OK" if info["opus_ok"] else "NOT OK", "" if info["opus_head_ok"] else "NOT ",
+                  info["channels"], info["sample_rate"] / 1000, info["page_count"]))
+    if not info["verified"]:
+        print("[ii] Page alignment, size, checksums, numbers and granule positions not verified")
+    else:
+        print("[{}] Page alignment {}OK and size {}OK"
+              .format("OK" if info["alignment_ok"] and info["page_size_ok"] else "NOT OK",
+                      "" if info["alignment_ok"] else "NOT ", "" if info["page_size_ok"] else "NOT "))
+        if info["page_error"] is None:
+            print("[OK] Page checksums, numbers and granule positions OK")
+        else:
+            print("[NOT OK] {}".format(info["page_error"]))
     print("")
-    print("[{}] File is {}valid".format("OK" if all_ok else "NOT OK", "" if all_ok else "NOT "))
+    if info["valid"] is None:
+        print("[ii] File is not verified")
+    else:
+        print("[{}] File is {}valid".format("OK" if info["valid"] else "NOT OK", "" if info["valid"] else "NOT "))
     print("")
-    print("[ii] Total runtime: {}".format(granule_to_time_string(total_time)))
-    print("[ii] {} Tracks:".format(len(chapters)))
-    for i in range(0, len(chapters)):
-        print("  Track {:02d}: {}".format(i + 1, chapters[i]))
-    return all_ok
+    print("[ii] Total runtime: {}".format(granule_to_time_string(info["total_time"])))
+    print("[ii] {} Tracks:".format(len(info["chapter_times"])))
+    for i in range(0, len(info["chapter_times"])):
+        print("  Track {:02d}: {}".format(i + 1, info["chapter_times"][i]))
+
+
+def check_tonie_file(filename, quick=False, json_output=False):
+    info = get_tonie_file_info(filename, quick)
+    if json_output:
+        print(json.dumps(info))
+    else:
+        print_tonie_file_info(info)
+    return info["valid"] is not False
+
+
+def get_tonie_file_info_or_error(filename, quick=False):
+    try:
+        return get_tonie_file_info(filename, quick)
+    except Exception as error:
+        return {"file": filename, "valid": False, "error": "{}: {}".format(type(error).__name__, error)}
+
+
+def check_tonie_files(filenames, quick=False, json_output=False, jobs=0, crc_backend="zlib"):
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    valid_count = 0
+    unverified_count = 0
+    # each worker maps and hashes its own file, so the checks run in parallel on separate cores
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=set_crc_backend,
+                                                initargs=(crc_backend,)) as executor:
+        for info in executor.map(get_tonie_file_info_or_error, filenames, itertools.repeat(quick)):
+            if info["valid"]:
+                valid_count = valid_count + 1
+            elif info["valid"] is None:
+                unverified_count = unverified_count + 1
+            if json_output:
+                print(json.dumps(info), flush=True)
+            elif "error" in info:
+                print("[NOT OK] {}: {}".format(info["file"], info["error"]), flush=True)
+            else:
+                status = "ii" if info["valid"] is None else "OK" if info["valid"] else "NOT OK"
+                print("[{}] {}: {} || {} tracks".format(status, info["file"],
+                                                        granule_to_time_string(info["total_time"]),
+                                                        len(info["chapter_times"])), flush=True)
+    invalid_count = len(filenames) - valid_count - unverified_count
+    if json_output:
+        print(json.dumps({"summary": {"files": len(filenames), "valid": valid_count,
+                                      "not_verified": unverified_count, "invalid": invalid_count}}))
+    else:
+        print("")
+        if invalid_count:
+            status = "NOT OK"
+        else:
+            status = "ii" if unverified_count else "OK"
+        summary = "{} of {} files valid".format(valid_count, len(filenames))
+        if quick:
+            summary = summary + ", {} not verified".format(unverified_count)
+        print("[{}] {}".format(status, summary))
+    return invalid_count == 0
+
+
+def get_tonie_files(input_filename):
+    if os.path.isdir(input_filename):
+        tonie_files = []
+        for dir_path, dir_names, file_names in os.walk(input_filename):
+            dir_names.sort()
+            for name in sorted(file_names):
+                tonie_files.append(os.path.join(dir_path, name))
+        return tonie_files
+    return sorted(filter_directories(glob.glob(input_filename, recursive=True)))
 
 
 def granule_to_time_string(granule, sample_rate=1):
@@ -841,89 +2349,532 @@ def granule_to_time_string(granule, sample_rate=1):
 
 
 def get_t2s_token():
-    assert T2S_AVAILABLE, "If you want to use the text2speech Google Cloud \n" \
+    assert is_t2s_available(), "If you want to use the text2speech Google Cloud \n" \
                           "service you need to install the librecaptcha package!"
+    librecaptcha = import_optional("librecaptcha")
     return librecaptcha.get_token(T2S_APIKEY, T2S_URL, librecaptcha.random_user_agent(), gui=True, debug=False)
 
 
-def get_t2s_base64_data(text):
-    token = "this-is-definitly-a-token"
-    json = {
-        "audioConfig": {
-            "audioEncoding": "LINEAR16",
-            "pitch": T2S_PITCH,
-            "speakingRate": T2S_SPEED
-        },
-        "input": {
-            "text": text
-        },
-        "voice": {
-            "languageCode": T2S_LANGUAGE,
-            "name": T2S_VOICE
+class T2SClient:
+    def __init__(self, endpoint=T2S_ENDPOINT, cache=None, jobs=T2S_JOBS):
+        self.endpoint = endpoint
+        self.cache = cache
+        self.jobs = jobs
+        self.token = "this-is-definitly-a-token"
+        self.session = None
+        self.executor = None
+        self.lock = threading.Lock()
+        self.token_lock = threading.Lock()
+        self.results = {}
+
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                # one pooled session keeps the connections to the endpoint alive between the requests
+                requests = import_optional("requests")
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.jobs)
+                self.session = requests.Session()
+                self.session.mount("http://", adapter)
+                self.session.mount("https://", adapter)
+            return self.session
+
+
+    def post(self, json, token):
+        return self.get_session().post(self.endpoint + token, json=json,
+                                       headers={"Content-Type": "application/json;charset=UTF-8"})
+
+
+    def get_base64_data(self, text):
+        json = {
+            "audioConfig": {
+                "audioEncoding": "LINEAR16",
+                "pitch": T2S_PITCH,
+                "speakingRate": T2S_SPEED
+            },
+            "input": {
+                "text": text
+            },
+            "voice": {
+                "languageCode": T2S_LANGUAGE,
+                "name": T2S_VOICE
+            }
         }
-    }
-    response = requests.post(T2S_ENDPOINT + token,
-                             json=json,
-                             headers={"Content-Type": "application/json;charset=UTF-8"})
+        token = self.token
+        response = self.post(json, token)
 
-    if response.status_code == 401:
-        token = get_t2s_token()
-        response = requests.post(T2S_ENDPOINT + token,
-                                 json=json,
-                                 headers={"Content-Type": "application/json;charset=UTF-8"})
+        if response.status_code == 401:
+            with self.token_lock:
+                # only solve the captcha once, other requests pick up the new token
+                if self.token == token:
+                    self.token = get_t2s_token()
+                token = self.token
+            response = self.post(json, token)
 
-    assert response.status_code == 200, \
-        "Got {} response when trying to get synthesized speech".format(response.status_code)
-    return response.json().get("audioContent")
+        assert response.status_code == 200, \
+            "Got {} response when trying to get synthesized speech".format(response.status_code)
+        return response.json().get("audioContent")
 
 
-def get_t2s_tempfile(ffmpeg_binary, opus_binary, text, bitrate, vbr=True):
-    t2s_base64 = get_t2s_base64_data(text)
+    def fetch(self, text):
+        if self.cache is not None:
+            cache_key = self.cache.get_speech_key(text)
+            cached_file = self.cache.lookup(cache_key, "wav")
+            if cached_file is not None:
+                with cached_file:
+                    return cached_file.read()
 
-    if not vbr:
-        vbr_parameter = "--hard-cbr"
-    else:
-        vbr_parameter = "--vbr"
+        data = base64.b64decode(self.get_base64_data(text))
+        if self.cache is not None:
+            self.cache.store(cache_key, io.BytesIO(data), "wav")
+        return data
 
-    ffmpeg_process = subprocess.Popen(
-        ["{}".format(ffmpeg_binary), "-hide_banner", "-loglevel", "warning", "-i", "pipe:", "-ac", "2", "-f", "wav",
-         "-ar", "48000", "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    opusenc_process = subprocess.Popen(
-        ["{}".format(opus_binary), "--quiet", vbr_parameter, "--bitrate", "{:d}".format(bitrate), "-", "-"],
-        stdin=ffmpeg_process.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
 
-    ffmpeg_process.stdin.write(base64.b64decode(t2s_base64))
-    ffmpeg_process.stdin.close()
+    def submit(self, text):
+        with self.lock:
+            future = self.results.get(text)
+            if future is None:
+                if self.executor is None:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+                future = self.results[text] = self.executor.submit(self.fetch, text)
+            return future
 
-    tmp_file = tempfile.SpooledTemporaryFile()
-    for c in iter(lambda: opusenc_process.stdout.read(1), b""):
-        tmp_file.write(c)
-    tmp_file.seek(0)
 
+    def prefetch(self, texts):
+        for text in texts:
+            self.submit(text)
+
+
+    def synthesize(self, text):
+        return self.submit(text).result()
+
+
+def init_t2s_client(endpoint=T2S_ENDPOINT, cache=None, jobs=T2S_JOBS):
+    global t2s_client
+    t2s_client = T2SClient(endpoint, cache, jobs)
+    return t2s_client
+
+
+def get_t2s_client():
+    with t2s_client_lock:
+        if t2s_client is None:
+            init_t2s_client()
+        return t2s_client
+
+
+def prefetch_t2s(input_files, bitrate, cbr, ffmpeg, opusenc, cache=None):
+    # all text entries are requested right away, they are synthesized while the tracks before them are encoded
+    texts = [fname[5:] for fname in input_files if fname.lower().startswith("text:")]
+    if cache is not None and texts:
+        encoder = get_encoder(ffmpeg)
+        texts = [text for text in texts
+                 if not cache.contains(cache.get_t2s_key(text, bitrate, not cbr, ffmpeg, opusenc, encoder))]
+    if texts:
+        get_t2s_client().prefetch(texts)
+
+
+def get_t2s_tempfile(ffmpeg_binary, opus_binary, text, bitrate, vbr=True, cache=None):
+    if cache is not None:
+        cache_key = cache.get_t2s_key(text, bitrate, vbr, ffmpeg_binary, opus_binary, get_encoder(ffmpeg_binary))
+        cached_file = cache.lookup(cache_key)
+        count_stat("cache_hits" if cached_file is not None else "cache_misses")
+        if cached_file is not None:
+            return cached_file
+
+    tmp_file = encode_opus(ffmpeg_binary, opus_binary, ["-i", "pipe:", "-ac", "2"], bitrate, vbr,
+                           "text:{}".format(text), get_t2s_client().synthesize(text))
+
+    if cache is not None:
+        cache.store(cache_key, tmp_file)
+    return tmp_file
+
+
+def get_opus_tempfile(ffmpeg_binary, opus_binary, filename, bitrate, vbr=True, cache=None, output="memory"):
+    if cache is not None:
+        cache_key = cache.get_key(filename, bitrate, vbr, ffmpeg_binary, opus_binary, get_encoder(ffmpeg_binary))
+        cached_file = cache.lookup(cache_key)
+        count_stat("cache_hits" if cached_file is not None else "cache_misses")
+        if cached_file is not None:
+            return cached_file
+
+    tmp_file = encode_opus(ffmpeg_binary, opus_binary, ["-i", "{}".format(filename), "-ac", "2"], bitrate, vbr,
+                           filename, output=output)
+
+    if cache is not None:
+        if output == "stream":
+            tmp_file.cache_to(cache, cache_key)
+        else:
+            cache.store(cache_key, tmp_file)
     return tmp_file
 
 
-def get_opus_tempfile(ffmpeg_binary, opus_binary, filename, bitrate, vbr=True):
+def get_remuxed_tempfile(ffmpeg_binary, filename, output="memory"):
+    # the first audio stream is copied into an ogg container, it is only used if it holds stereo CELT packets
+    command = ["{}".format(ffmpeg_binary), "-hide_banner", "-loglevel", "quiet", "-i", "{}".format(filename),
+               "-map", "0:a:0", "-c:a", "copy", "-map_metadata", "-1", "-f", "ogg", "-"]
+    try:
+        tmp_file = run_encoder_pipeline([command], filename, output="memory" if output == "memory" else "disk")
+    except (RuntimeError, OSError):
+        return None
+
+    in_file = MappedFile(tmp_file)
+    try:
+        copyable = is_copyable_opus(in_file)
+    finally:
+        in_file.close()
+    if not copyable:
+        tmp_file.close()
+        return None
+    tmp_file.seek(0)
+    return tmp_file
+
+
+def set_encoder_backend(name):
+    global encoder_backend
+    if name not in ENCODERS:
+        raise RuntimeError("Unknown encoder {} - available: {}".format(name, ", ".join(ENCODERS)))
+    encoder_backend = name
+
+
+@functools.lru_cache(maxsize=None)
+def has_libopus_encoder(ffmpeg_binary):
+    # a short encode of silence tells if this ffmpeg build has libopus and accepts all options used for it
+    command = get_libopus_command(ffmpeg_binary, ["-f", "s16le", "-ar", "48000", "-ac", "2", "-i", "pipe:"], 96, True)
+    try:
+        result = subprocess.run(command, input=bytes(48000 * 4 // 10), stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+    except OSError:
+        return False
+    return result.returncode == 0
+
+
+def get_encoder(ffmpeg_binary):
+    if encoder_backend == "auto":
+        return "libopus" if has_libopus_encoder(ffmpeg_binary) else "opusenc"
+    return encoder_backend
+
+
+def get_libopus_command(ffmpeg_binary, input_arguments, bitrate, vbr):
+    # restricted low delay makes libopus encode CELT only frames, like opusenc does for 20 ms frames
+    return ["{}".format(ffmpeg_binary), "-hide_banner", "-loglevel", "warning"] + input_arguments + \
+           ["-vn", "-ar", "48000", "-c:a", "libopus", "-application", "lowdelay", "-frame_duration", "20",
+            "-vbr", "on" if vbr else "off", "-b:a", "{:d}k".format(bitrate), "-f", "ogg", "-"]
+
+
+def get_opusenc_commands(ffmpeg_binary, opus_binary, input_arguments, bitrate, vbr):
     if not vbr:
         vbr_parameter = "--hard-cbr"
     else:
         vbr_parameter = "--vbr"
 
-    ffmpeg_process = subprocess.Popen(
-        ["{}".format(ffmpeg_binary), "-hide_banner", "-loglevel", "warning", "-i", "{}".format(filename), "-f", "wav",
-         "-ar", "48000", "-"], stdout=subprocess.PIPE)
-    opusenc_process = subprocess.Popen(
-        ["{}".format(opus_binary), "--quiet", vbr_parameter, "--bitrate", "{:d}".format(bitrate), "-", "-"],
-        stdin=ffmpeg_process.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return [["{}".format(ffmpeg_binary), "-hide_banner", "-loglevel", "warning"] + input_arguments +
+            ["-f", "wav", "-ar", "48000", "-"],
+            ["{}".format(opus_binary), "--quiet", vbr_parameter, "--bitrate", "{:d}".format(bitrate), "-", "-"]]
+
+
+def encode_opus(ffmpeg_binary, opus_binary, input_arguments, bitrate, vbr, source, input_data=None,
+                output="memory"):
+    if get_encoder(ffmpeg_binary) == "libopus":
+        return run_encoder_pipeline([get_libopus_command(ffmpeg_binary, input_arguments, bitrate, vbr)], source,
+                                    input_data, output)
+    return run_encoder_pipeline(get_opusenc_commands(ffmpeg_binary, opus_binary, input_arguments, bitrate, vbr),
+                                source, input_data, output)
+
+
+def write_process_input(stream, data):
+    try:
+        stream.write(data)
+        stream.close()
+    except BrokenPipeError:
+        pass  # the exit code of the process tells what went wrong
+
+
+class EncoderStream:
+    def __init__(self, commands, source, input_data=None):
+        self.commands = commands
+        self.source = source
+        self.processes = []
+        stdin = subprocess.DEVNULL if input_data is None else subprocess.PIPE
+        for command in commands:
+            process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE,
+                                       stderr=None if not self.processes else subprocess.DEVNULL)
+            if self.processes:
+                # the next process holds the read end now, the previous one has to notice when it goes away
+                stdin.close()
+            self.processes.append(process)
+            stdin = process.stdout
+        self.stdout = self.processes[-1].stdout
+
+        self.feeder = None
+        if input_data is not None:
+            self.feeder = threading.Thread(target=write_process_input, args=(self.processes[0].stdin, input_data),
+                                           daemon=True)
+            self.feeder.start()
+        self.finished = False
+        self.cache = None
+        self.cache_key = None
+        self.cache_file = None
+
+
+    def cache_to(self, cache, key):
+        # the output is copied into the cache while it is read and only kept if the encoder succeeds
+        self.cache = cache
+        self.cache_key = key
+        self.cache_file = cache.create_object_file()
+
+
+    def wait_for_data(self):
+        # an encoder that cannot start exits before writing anything
+        if not self.stdout.peek(1):
+            self.finish()
+
+
+    def read(self, size=-1):
+        if self.finished:
+            return b""
+        data = self.stdout.read(size)
+        if self.cache_file is not None:
+            self.cache_file.write(data)
+        if size < 0 or len(data) < size:
+            # the exit codes are checked before the last bytes are used
+            self.finish()
+        return data
+
+
+    def copy_to(self, tmp_file):
+        shutil.copyfileobj(self.stdout, tmp_file, COPY_BUFFER_SIZE)
+        self.finish()
+
+
+    def wait(self):
+        self.stdout.close()
+        results = [process.wait() for process in reversed(self.processes)][::-1]
+        if self.feeder is not None:
+            self.feeder.join()
+        return results
+
+
+    def finish(self):
+        self.finished = True
+        results = self.wait()
+        if any(results):
+            exit_codes = ["{} exit code {}".format(os.path.basename(command[0]), result)
+                          for command, result in zip(self.commands, results)]
+            raise RuntimeError("Encoding {} failed: {}".format(self.source, ", ".join(exit_codes)))
+        if self.cache_file is not None:
+            self.cache.commit(self.cache_key, self.cache_file)
+            self.cache_file = None
+
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            for process in self.processes:
+                process.terminate()
+            self.wait()
+        if self.cache_file is not None:
+            self.cache.discard(self.cache_file)
+            self.cache_file = None
+
+
+def run_encoder_pipeline(commands, source, input_data=None, output="memory"):
+    # output is "memory", "disk" (an anonymous temporary file) or "stream" (read straight from the pipe)
+    stream = EncoderStream(commands, source, input_data)
+    if output == "stream":
+        try:
+            stream.wait_for_data()
+        except BaseException:
+            stream.close()
+            raise
+        return stream
+
+    tmp_file = tempfile.TemporaryFile() if output == "disk" else tempfile.SpooledTemporaryFile()
+    try:
+        stream.copy_to(tmp_file)
+    except BaseException:
+        tmp_file.close()
+        raise
+    finally:
+        stream.close()
 
-    tmp_file = tempfile.SpooledTemporaryFile()
-    for c in iter(lambda: opusenc_process.stdout.read(1), b""):
-        tmp_file.write(c)
     tmp_file.seek(0)
-
     return tmp_file
 
 
+@functools.lru_cache(maxsize=None)
+def get_tool_version(binary, version_argument):
+    try:
+        output = subprocess.run([binary, version_argument], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except OSError:
+        return ""
+    lines = output.decode(errors="replace").splitlines()
+    return lines[0] if lines else ""
+
+
+def get_default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "opus2tonie")
+
+
+class TranscodeCache:
+    def __init__(self, path, max_size=CACHE_DEFAULT_SIZE_MB * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.object_dir = os.path.join(path, "objects")
+        self.source_dir = os.path.join(path, "sources")
+        os.makedirs(self.object_dir, exist_ok=True)
+        os.makedirs(self.source_dir, exist_ok=True)
+
+
+    def get_source_hash(self, filename):
+        # size, mtime and inode identify unchanged sources without hashing their content again
+        stat = os.stat(filename)
+        stat_key = "{}\0{}\0{}\0{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        index_file = os.path.join(self.source_dir, hashlib.sha1(stat_key.encode()).hexdigest())
+        try:
+            with open(index_file) as index:
+                return index.read().strip()
+        except OSError:
+            pass
+
+        content_hash = hashlib.sha256()
+        with open(filename, "rb") as source:
+            for chunk in iter(lambda: source.read(COPY_BUFFER_SIZE), b""):
+                content_hash.update(chunk)
+        self.write_atomic(index_file, content_hash.hexdigest().encode())
+        return content_hash.hexdigest()
+
+
+    def get_key(self, filename, bitrate, vbr, ffmpeg_binary, opus_binary, encoder="opusenc"):
+        return self.get_encoding_key(self.get_source_hash(filename), bitrate, vbr, ffmpeg_binary, opus_binary, encoder)
+
+
+    def get_speech_key(self, text):
+        key = "\0".join([CACHE_FORMAT, "text2speech", T2S_VOICE, T2S_LANGUAGE, repr(T2S_SPEED), repr(T2S_PITCH), text])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+    def get_t2s_key(self, text, bitrate, vbr, ffmpeg_binary, opus_binary, encoder="opusenc"):
+        return self.get_encoding_key(self.get_speech_key(text), bitrate, vbr, ffmpeg_binary, opus_binary, encoder)
+
+
+    def get_encoding_key(self, source_hash, bitrate, vbr, ffmpeg_binary, opus_binary, encoder):
+        # the source hash leads the key, so pruning can tell which source index entries are still used
+        settings = "\0".join([
+            CACHE_FORMAT,
+            "{:d}".format(bitrate),
+            "vbr" if vbr else "cbr",
+            get_tool_version(ffmpeg_binary, "-version"),
+            get_tool_version(opus_binary, "--version") if encoder == "opusenc" else encoder
+        ])
+        return "{}-{}".format(source_hash, hashlib.sha256(settings.encode()).hexdigest())
+
+
+    def get_object_path(self, key, extension="opus"):
+        return os.path.join(self.object_dir, "{}.{}".format(key, extension))
+
+
+    def contains(self, key, extension="opus"):
+        return os.path.exists(self.get_object_path(key, extension))
+
+
+    def lookup(self, key, extension="opus"):
+        path = self.get_object_path(key, extension)
+        try:
+            handle = open(path, "rb")
+        except OSError:
+            return None
+        os.utime(path)  # the modification time doubles as last access time for the LRU eviction
+        return handle
+
+
+    def store(self, key, tmp_file, extension="opus"):
+        position = tmp_file.tell()
+        object_file = self.create_object_file()
+        shutil.copyfileobj(tmp_file, object_file, COPY_BUFFER_SIZE)
+        self.commit(key, object_file, extension)
+        tmp_file.seek(position)
+
+
+    def create_object_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.object_dir, suffix=".tmp", delete=False)
+
+
+    def commit(self, key, object_file, extension="opus"):
+        object_file.close()
+        os.replace(object_file.name, self.get_object_path(key, extension))
+        self.prune()
+
+
+    def discard(self, object_file):
+        object_file.close()
+        try:
+            os.remove(object_file.name)
+        except OSError:
+            pass
+
+
+    def write_atomic(self, path, data):
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_file.name, path)
+
+
+    def get_objects(self):
+        objects = []
+        for entry in os.scandir(self.object_dir):
+            if entry.name.endswith((".opus", ".wav")):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(objects)
+
+
+    def get_info(self):
+        objects = self.get_objects()
+        return len(objects), sum(size for _, size, _ in objects)
+
+
+    def prune(self, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+        objects = self.get_objects()
+        total_size = sum(size for _, size, _ in objects)
+        removed = 0
+        for _, size, path in objects:
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size = total_size - size
+            removed = removed + 1
+        if removed:
+            self.prune_sources()
+        return removed, total_size
+
+
+    def prune_sources(self):
+        # drops the index entries of sources whose encodings were all evicted
+        source_hashes = set(os.path.basename(path).split("-")[0] for _, _, path in self.get_objects())
+        removed = 0
+        for entry in os.scandir(self.source_dir):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                with open(entry.path) as index:
+                    source_hash = index.read().strip()
+                if source_hash not in source_hashes:
+                    os.remove(entry.path)
+                    removed = removed + 1
+            except OSError:
+                continue
+        return removed
+
+
 def filter_directories(glob_list):
     result = []
     for name in glob_list:
@@ -939,8 +2890,8 @@ def get_input_files(input_filename):
         with open(input_filename) as file_list:
             for line in file_list:
                 fname = line.rstrip()
-                if fname.startswith("text:") and not T2S_AVAILABLE:
-                    raise RuntimeError("You cannot use text2speech (\"text:\" list entries) without librecaptcha")
+                if fname.startswith("text:") and import_optional("requests") is None:
+                    raise RuntimeError("You cannot use text2speech (\"text:\" list entries) without requests")
                 if os.path.isabs(fname) or fname.startswith("text:"):
                     input_files.append(fname)
                 else:
@@ -950,105 +2901,272 @@ def get_input_files(input_filename):
     return input_files
 
 
-def split_to_opus_files(filename, output):
-    with open(filename, "rb") as in_file:
-        tonie_header = tonie_header_pb2.TonieHeader()
-        header_size = struct.unpack(">L", in_file.read(4))[0]
-        tonie_header = tonie_header.FromString(in_file.read(header_size))
+def get_page_locator(in_file):
+    reader = TonieReader(in_file)
+    try:
+        reader.read_page(2)
+        reader.read_page(reader.get_last_page().page_no)
 
-        abs_path = os.path.abspath(filename)
-        if output:
-            if not os.path.exists(output):
-                os.makedirs(output)
-            path = output
-        else:
-            path = os.path.dirname(abs_path)
-        name = os.path.basename(abs_path)
-        pos = name.rfind('.')
-        if pos == -1:
-            name = name + ".opus"
-        else:
-            name = name[:pos] + ".opus"
-        filename_template = "{{:02d}}_{}".format(name)
-        out_path = "{}{}".format(path, os.path.sep)
+        def locate(page_no):
+            page = reader.read_page(page_no)
+            return reader.get_page_offset(page_no), page.granule_position
+        return reader, locate
+    except RuntimeError:
+        pass
 
+    # the pages are not where a Tonie file keeps them, so index them once
+    pages = {}
+    in_file.seek(reader.audio_start)
+    found = OggPage.seek_to_page_header(in_file)
+    while found:
+        offset = in_file.tell()
+        page = OggPage(in_file)
+        pages[page.page_no] = offset, page.granule_position
         found = OggPage.seek_to_page_header(in_file)
-        if not found:
-            raise RuntimeError("First ogg page not found")
-        first_page = OggPage(in_file)
 
-        found = OggPage.seek_to_page_header(in_file)
-        if not found:
-            raise RuntimeError("Second ogg page not found")
-        second_page = OggPage(in_file)
+    def locate(page_no):
+        if page_no not in pages:
+            raise RuntimeError("Page {} not found".format(page_no))
+        return pages[page_no]
+    return reader, locate
+
+
+def get_chapter_ranges(in_file):
+    reader, locate = get_page_locator(in_file)
+    chapter_pages = list(reader.tonie_header.chapterPages)
+    header_end = locate(2)[0]
+    ranges = []
+    for i in range(0, len(chapter_pages)):
+        start_page = max(chapter_pages[i], 2)
+        start = locate(start_page)[0]
+        base_granule = locate(start_page - 1)[1] if start_page > 2 else 0
+        if (i + 1) < len(chapter_pages):
+            end = locate(chapter_pages[i + 1])[0]
+        else:
+            end = in_file.size
+        ranges.append((start, end, base_granule))
+    return reader.audio_start, header_end, ranges
+
+
+def extract_chapter(filename, out_filename, header_start, header_end, start, end, base_granule):
+    with open(filename, "rb") as raw_file:
+        in_file = MappedFile(raw_file)
+        try:
+            with open(out_filename, "wb") as out_file:
+                out_file.write(in_file.buffer[header_start:header_end])
+                out_data = bytearray()
+                position = start
+                while position < end:
+                    # only the granule position and the checksum change, the rest of the page is copied as is
+                    if position + 27 > end or in_file.buffer[position:position + 4] != b"OggS":
+                        raise RuntimeError("No ogg page at offset 0x{:X}".format(position))
+                    segment_count = in_file.buffer[position + 26]
+                    page_size = 27 + segment_count + sum(in_file.buffer[position + 27:position + 27 + segment_count])
+                    page = bytearray(in_file.buffer[position:position + page_size])
+                    if len(page) < page_size:
+                        raise RuntimeError("Ogg page at offset 0x{:X} is truncated".format(position))
+                    granule = struct.unpack_from("<Q", page, 6)[0]
+                    struct.pack_into("<Q", page, 6, granule - base_granule)
+                    page[22:26] = bytes(4)
+                    struct.pack_into("<L", page, 22, crc_function(page))
+                    out_data += page
+                    if len(out_data) >= COPY_BUFFER_SIZE:
+                        out_file.write(out_data)
+                        out_data = bytearray()
+                    position = position + page_size
+                out_file.write(out_data)
+        finally:
+            in_file.close()
+
+
+def parse_chapter_selection(selection, chapter_count):
+    chapters = set()
+    for part in selection.split(","):
+        first, _, last = part.strip().partition("-")
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise RuntimeError("Invalid chapter selection {}".format(selection))
+        if first < 1 or last > chapter_count or first > last:
+            raise RuntimeError("Chapters {} out of range, the file has {} chapters".format(part.strip(),
+                                                                                         chapter_count))
+        chapters.update(range(first, last + 1))
+    return sorted(chapters)
+
+
+def split_to_opus_files(filename, output=None, selection=None, jobs=0, crc_backend="zlib", verbose=True):
+    with open(filename, "rb") as raw_file:
+        in_file = MappedFile(raw_file)
+        header_start, header_end, ranges = get_chapter_ranges(in_file)
+        in_file.close()
+
+    abs_path = os.path.abspath(filename)
+    if output:
+        if not os.path.exists(output):
+            os.makedirs(output)
+        path = output
+    else:
+        path = os.path.dirname(abs_path)
+    name = os.path.basename(abs_path)
+    pos = name.rfind('.')
+    if pos == -1:
+        name = name + ".opus"
+    else:
+        name = name[:pos] + ".opus"
+    filename_template = "{{:02d}}_{}".format(name)
+    out_path = "{}{}".format(path, os.path.sep)
 
-        found = OggPage.seek_to_page_header(in_file)
-        page = OggPage(in_file)
+    pad_len = math.ceil(math.log(len(ranges) + 1, 10))
+    format_string = "[{{:0{}d}}/{:0{}d}] {{}}".format(pad_len, len(ranges), pad_len)
+
+    if selection is None:
+        chapters = range(1, len(ranges) + 1)
+    else:
+        chapters = parse_chapter_selection(selection, len(ranges))
+    if len(chapters) == 0:
+        return []
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+
+    # every chapter is a known byte range, so the chapters are extracted independently of each other
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(chapters)), initializer=set_crc_backend,
+                                                initargs=(crc_backend,)) as executor:
+        futures = []
+        out_filenames = []
+        for chapter in chapters:
+            out_filename = "{}{}".format(out_path, filename_template.format(chapter))
+            futures.append(executor.submit(extract_chapter, filename, out_filename, header_start, header_end,
+                                           *ranges[chapter - 1]))
+            out_filenames.append(out_filename)
+        for chapter, future in zip(chapters, futures):
+            future.result()
+            if verbose:
+                print(format_string.format(chapter, filename_template.format(chapter)))
+    return out_filenames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create Tonie compatible file from Ogg opus file(s).')
+    parser.add_argument('input_filename', metavar='SOURCE', nargs='?', type=str,
+                        help='input file or directory or a file list (.lst)')
+    parser.add_argument('output_filename', metavar='TARGET', nargs='?', type=str,
+                        help='the output file name (default: 500304E0)')
+    parser.add_argument('--ts', dest='user_timestamp', metavar='TIMESTAMP', action='store',
+                        help='set custom timestamp / bitstream serial')
+
+    parser.add_argument('--ffmpeg', help='specify location of ffmpeg', default='ffmpeg')
+    parser.add_argument('--opusenc', help='specify location of opusenc', default='opusenc')
+    parser.add_argument('--encoder', choices=ENCODERS, default='auto',
+                        help='encode with the libopus encoder of ffmpeg or pipe through opusenc '
+                             '(default: auto, libopus if ffmpeg supports it)')
+    parser.add_argument('--bitrate', type=int, help='set encoding bitrate in kbps (default: 96)', default=96)
+    parser.add_argument('--cbr', action='store_true', help='encode in cbr mode')
+    parser.add_argument('--stream', action='store_true',
+                        help='pack the pages while the encoder is still running instead of keeping whole tracks in '
+                             'memory (with --jobs the tracks encoded ahead are kept in temporary files)')
+    parser.add_argument('--jobs', type=int, nargs='?', const=0, metavar='N',
+                        help='process up to N files in parallel (default: 1 when transcoding a single Tonie file, '
+                             'number of CPUs for --manifest or --info on several files, without N: number of CPUs)')
+    parser.add_argument('--cache', dest='cache_dir', nargs='?', const=get_default_cache_dir(), metavar='DIR',
+                        help='reuse transcoded files from DIR (default: ~/.cache/opus2tonie)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_DEFAULT_SIZE_MB, metavar='MB',
+                        help='maximum size of the transcode cache (default: {})'.format(CACHE_DEFAULT_SIZE_MB))
+    parser.add_argument('--cache-info', action='store_true', help='display info about the transcode cache')
+    parser.add_argument('--cache-prune', action='store_true', help='shrink the transcode cache to --cache-size')
+
+    parser.add_argument('--t2s-endpoint', metavar='URL', default=T2S_ENDPOINT,
+                        help='send text2speech requests to URL, the token is appended (default: Google Cloud)')
+
+    parser.add_argument('--append-tonie-filename', action='store_true', help='append [500304E0] to filename')
+    parser.add_argument('--no-tonie-header', action='store_true', help='do not write Tonie header')
+    parser.add_argument('--append', action='store_true', help='append SOURCE to the existing Tonie file TARGET')
+    parser.add_argument('--manifest', metavar='FILE', help='build all Tonie files listed in the JSON manifest FILE')
+    parser.add_argument('--info', action='store_true', help='Check and display info about Tonie file')
+    parser.add_argument('--quick', action='store_true',
+                        help='with --info only read the chapter pages instead of verifying the whole file')
+    parser.add_argument('--json', action='store_true', help='with --info print one JSON record per file')
+    parser.add_argument('--split', action='store_true', help='Split Tonie file into opus tracks')
+    parser.add_argument('--chapters', metavar='LIST',
+                        help='with --split only extract the given chapters, e.g. 1,3,5-7')
+    parser.add_argument('--stats', action='store_true', help='print time spent per stage and track after a build')
+    parser.add_argument('--stats-json', metavar='FILE', help='write the build statistics as JSON to FILE (- for stdout)')
+    parser.add_argument('--crc', dest='crc_backend', choices=list(CRC_BACKENDS), default='zlib',
+                        help='select ogg checksum implementation (default: zlib)')
+
+    args = parser.parse_args()
+    set_crc_backend(args.crc_backend)
+    set_encoder_backend(args.encoder)
+
+    cache = None
+    if args.cache_dir or args.cache_info or args.cache_prune:
+        cache = TranscodeCache(args.cache_dir or get_default_cache_dir(), args.cache_size * 1024 * 1024)
+        if args.cache_prune:
+            removed, size = cache.prune()
+            cache.prune_sources()
+            print("Removed {} cached files".format(removed))
+        if args.cache_info or args.cache_prune:
+            count, size = cache.get_info()
+            print("Transcode cache {}: {} files, {:.1f} MB".format(cache.path, count, size / 1024 / 1024))
+            sys.exit(0)
+
+    init_t2s_client(args.t2s_endpoint, cache)
+
+    stats = None
+    if args.stats or args.stats_json:
+        stats = enable_build_stats()
+
+    if args.manifest:
+        targets = read_manifest(args.manifest, args.bitrate, args.cbr)
+        ok = build_manifest(targets, args.ffmpeg, args.opusenc, args.jobs or 0, cache, args.crc_backend)
+        report_build_stats(stats, args.stats, args.stats_json)
+        sys.exit(0 if ok else 1)
 
-        pad_len = math.ceil(math.log(len(tonie_header.chapterPages) + 1, 10))
-        format_string = "[{{:0{}d}}/{:0{}d}] {{}}".format(pad_len, len(tonie_header.chapterPages), pad_len)
+    if args.input_filename is None:
+        parser.error("the following arguments are required: SOURCE")
 
-        for i in range(0, len(tonie_header.chapterPages)):
-            if (i + 1) < len(tonie_header.chapterPages):
-                end_page = tonie_header.chapterPages[i + 1]
-            else:
-                end_page = 0
-            granule = 0
-            print(format_string.format(i + 1, filename_template.format(i + 1)))
-            with open("{}{}".format(out_path, filename_template.format(i + 1)), "wb") as out_file:
-                first_page.write_page(out_file)
-                second_page.write_page(out_file)
-                while found and ((page.page_no < end_page) or (end_page == 0)):
-                    page.correct_values(granule)
-                    granule = page.granule_position
-                    page.write_page(out_file)
-                    found = OggPage.seek_to_page_header(in_file)
-                    if found:
-                        page = OggPage(in_file)
-
-
-crc_table = create_table()
-
-parser = argparse.ArgumentParser(description='Create Tonie compatible file from Ogg opus file(s).')
-parser.add_argument('input_filename', metavar='SOURCE', type=str, help='input file or directory or a file list (.lst)')
-parser.add_argument('output_filename', metavar='TARGET', nargs='?', type=str,
-                    help='the output file name (default: 500304E0)')
-parser.add_argument('--ts', dest='user_timestamp', metavar='TIMESTAMP', action='store',
-                    help='set custom timestamp / bitstream serial')
-
-parser.add_argument('--ffmpeg', help='specify location of ffmpeg', default='ffmpeg')
-parser.add_argument('--opusenc', help='specify location of opusenc', default='opusenc')
-parser.add_argument('--bitrate', type=int, help='set encoding bitrate in kbps (default: 96)', default=96)
-parser.add_argument('--cbr', action='store_true', help='encode in cbr mode')
-
-parser.add_argument('--append-tonie-filename', action='store_true', help='append [500304E0] to filename')
-parser.add_argument('--no-tonie-header', action='store_true', help='do not write Tonie header')
-parser.add_argument('--info', action='store_true', help='Check and display info about Tonie file')
-parser.add_argument('--split', action='store_true', help='Split Tonie file into opus tracks')
-
-args = parser.parse_args()
-
-
-if os.path.isdir(args.input_filename):
-    args.input_filename += "/*"
-else:
     if args.info:
-        ok = check_tonie_file(args.input_filename)
+        if os.path.isfile(args.input_filename):
+            ok = check_tonie_file(args.input_filename, args.quick, args.json)
+        else:
+            tonie_files = get_tonie_files(args.input_filename)
+            if len(tonie_files) == 0:
+                print("No files found for pattern {}".format(args.input_filename))
+                sys.exit(1)
+            ok = check_tonie_files(tonie_files, args.quick, args.json, args.jobs or 0, args.crc_backend)
         sys.exit(0 if ok else 1)
+
+    jobs = 1 if args.jobs is None else args.jobs
+    if os.path.isdir(args.input_filename):
+        args.input_filename += "/*"
     elif args.split:
-        split_to_opus_files(args.input_filename, args.output_filename)
+        split_to_opus_files(args.input_filename, args.output_filename, args.chapters, args.jobs or 0,
+                            args.crc_backend)
+        sys.exit(0)
+
+    files = get_input_files(args.input_filename)
+
+    if len(files) == 0:
+        print("No files found for pattern {}".format(args.input_filename))
+        sys.exit(1)
+
+    if args.append:
+        if not args.output_filename:
+            parser.error("--append requires a TARGET Tonie file")
+        append_to_tonie_file(args.output_filename, files, args.bitrate, args.cbr, args.ffmpeg, args.opusenc,
+                             jobs, cache, stream=args.stream)
+        report_build_stats(stats, args.stats, args.stats_json)
         sys.exit(0)
 
-files = get_input_files(args.input_filename)
+    out_filename = args.output_filename if args.output_filename else '500304E0'
 
-if len(files) == 0:
-    print("No files found for pattern {}".format(args.input_filename))
-    sys.exit(1)
+    if args.append_tonie_filename and args.output_filename:
+        out_filename = append_to_filename(args.output_filename, "[500304E0]")
 
-out_filename = args.output_filename if args.output_filename else '500304E0'
+    create_tonie_file(out_filename, files, args.no_tonie_header, args.user_timestamp,
+                      args.bitrate, args.cbr, args.ffmpeg, args.opusenc, jobs, cache, stream=args.stream)
+    report_build_stats(stats, args.stats, args.stats_json)
 
-if args.append_tonie_filename and args.output_filename:
-    out_filename = append_to_filename(args.output_filename, "[500304E0]")
 
-create_tonie_file(out_filename, files, args.no_tonie_header, args.user_timestamp,
-                  args.bitrate, args.cbr, args.ffmpeg, args.opusenc)
+if __name__ == '__main__':
+    main()